@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the airfield_scraper pipeline against synthetic data
+
+Writes region .htm pages in the airfields-freeman.com layout, a BTS master
+coordinate csv and a fixed-width NFDC APT.txt with the requested number of
+facilities into a scratch directory, then times the readers, the comparison
+and the kml writer there, each in a fresh process so its peak memory is its
+own. Throughput and peak memory are reported against a stored baseline so
+regressions show up between runs.
+
+Usage: python airfield_benchmark.py --scale 10000 [--save-baseline]
+"""
+
+import os
+import sys
+import csv
+import json
+import random
+import shutil
+import tempfile
+import argparse
+import contextlib
+import multiprocessing
+
+import airfield_scraper
+
+baseline_file = 'benchmark_baseline.json'
+benchmark_stages = ['read_airport_files', 'get_bts_airport_list', 'get_nfdc_airport_list', 'compare_locations', 'write_kml_file']
+states = ['AK', 'AZ', 'CA', 'CO', 'FL', 'GA', 'IL', 'MI', 'NY', 'OH', 'PA', 'TX', 'WA']
+bts_header = ['AIRPORT_SEQ_ID', 'AIRPORT_ID', 'AIRPORT', 'DISPLAY_AIRPORT_NAME', 'DISPLAY_AIRPORT_CITY_NAME_FULL',
+              'AIRPORT_WAC', 'AIRPORT_COUNTRY_NAME', 'AIRPORT_COUNTRY_CODE_ISO', 'AIRPORT_STATE_NAME',
+              'AIRPORT_STATE_CODE', 'AIRPORT_STATE_FIPS', 'CITY_MARKET_ID', 'DISPLAY_CITY_MARKET_NAME_FULL',
+              'CITY_MARKET_WAC', 'LAT_DEGREES', 'LAT_HEMISPHERE', 'LAT_MINUTES', 'LAT_SECONDS', 'LATITUDE',
+              'LON_DEGREES', 'LON_HEMISPHERE', 'LON_MINUTES', 'LON_SECONDS', 'LONGITUDE', 'AIRPORT_START_DATE',
+              'AIRPORT_THRU_DATE', 'AIRPORT_IS_CLOSED', 'AIRPORT_IS_LATEST']
+
+
+def get_synthetic_locations(count, seed=0):
+    """Return count (state, lat, lon) tuples spread over the continental US"""
+    generator = random.Random(seed)
+    return [(generator.choice(states), generator.uniform(25.0, 49.0), generator.uniform(-124.0, -67.0)) for i in range(count)]
+
+
+def jitter(generator, value, km):
+    """Move a coordinate by up to roughly km kilometres"""
+    return value + generator.uniform(-km, km)/111.0
+
+
+def write_synthetic_pages(count, seed=0, per_page=200):
+    """Write region pages holding count abandoned airfields, return the number written"""
+    generator = random.Random(seed + 1)
+    locations = get_synthetic_locations(count, seed)
+    pages = dict()
+    for i, (state, lat, lon) in enumerate(locations):
+        region = 'R{}'.format(i//per_page)
+        pages.setdefault((state, region), []).append(
+            '<p><img src="pics/{0}.jpg">_____________________________________________________<br>\n'
+            '<a name="{0}"></a><b>Field {0} ({1}{0:04d}), Town {2}, {1}</b>\n<br>\n'
+            '{3:.2f} North / {4:.2f} West (<font color="blue">{5}</font>)</p>\n'
+            '<p>Built in 19{6:02d} &amp; closed some years later, the field had a single turf runway.</p>\n'.format(
+                i % 10000, state, generator.randint(1, 500), jitter(generator, lat, 3), -jitter(generator, lon, 3),
+                generator.choice(['Northern', 'Central', 'Southern']), generator.randint(20, 99)))
+    for (state, region), airfields in pages.items():
+        with open('Airfields_{}_{}.htm'.format(state, region), 'w') as page_file:
+            page_file.write('<html><head><title>Abandoned &amp; Little-Known Airfields: {}</title></head><body>\n'.format(state))
+            page_file.write(''.join(airfields))
+            page_file.write('</body></html>\n')
+    return count
+
+
+def write_synthetic_bts(count, seed=0, path='737306034_T_MASTER_CORD.csv'):
+    """Write a BTS master coordinate csv with count rows, most of them current US airports"""
+    generator = random.Random(seed + 2)
+    with open(path, 'wb') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(bts_header)
+        for i, (state, lat, lon) in enumerate(get_synthetic_locations(count, seed)):
+            row = [''] * len(bts_header)
+            row[0:5] = [str(i*10 + 1), str(10000 + i), 'B{:03d}'.format(i % 1000), 'Airport {}'.format(i), 'City {}, {}'.format(i % 500, state)]
+            row[7] = 'US' if generator.random() < 0.95 else 'CA'
+            row[9] = state
+            row[18] = '{:.8f}'.format(jitter(generator, lat, 0.5))
+            row[23] = '{:.8f}'.format(jitter(generator, lon, 0.5))
+            row[24] = '1990-01-01'
+            row[26] = '1' if generator.random() < 0.1 else '0'
+            row[27] = '1' if generator.random() < 0.9 else '0'
+            writer.writerow(row)
+    return count
+
+
+def write_synthetic_apt(count, seed=0, path='APT.txt', other_records=4):
+    """Write an NFDC APT.txt with count APT records and other record types between them"""
+    generator = random.Random(seed + 3)
+    line_length = airfield_scraper.apt_columns[-1][2]
+    with open(path, 'wb') as apt_file:
+        for i, (state, lat, lon) in enumerate(get_synthetic_locations(count, seed)):
+            #Most facilities match a BTS airport, the rest are somewhere else entirely
+            if generator.random() < 0.1:
+                lat, lon = generator.uniform(25.0, 49.0), generator.uniform(-124.0, -67.0)
+            line = [' '] * line_length
+            fields = [(0, 'APT'), (3, '{:05d}.*A'.format(i)), (14, 'AIRPORT'), (27, 'N{:03d}'.format(i % 1000)),
+                      (31, '08/17/2017'), (48, state), (93, 'CITY {}'.format(i % 500)), (133, 'FACILITY {}'.format(i)),
+                      (538, '{:.4f}N'.format(jitter(generator, lat, 0.5)*3600)),
+                      (565, '{:.4f}W'.format(-jitter(generator, lon, 0.5)*3600))]
+            for start, value in fields:
+                line[start:start + len(value)] = value
+            apt_file.write(''.join(line) + '\r\n')
+            for j in range(generator.randint(0, other_records*2)):
+                apt_file.write('{}{:05d}.*A{}\r\n'.format(generator.choice(['ATT', 'RWY', 'RMK', 'ARS']), i, ' '*generator.randint(100, 1500)))
+    return count
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silence the pipeline's progress output while a stage is timed"""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def write_fixtures(scale, seed, connection):
+    """Write the synthetic sources for scale facilities into the current directory"""
+    write_synthetic_pages(scale, seed)
+    write_synthetic_bts(scale, seed)
+    write_synthetic_apt(scale, seed)
+    connection.send(None)
+
+
+def time_stage(name, workers, connection):
+    """Time one stage, loading whatever it needs first, and send back its PipelineStats record"""
+    stats = airfield_scraper.PipelineStats()
+    with quiet():
+        if name == 'compare_locations':
+            nfdc_airports = airfield_scraper.get_nfdc_airport_list(snapshot_path=None)
+            bts_airports = airfield_scraper.get_bts_airport_list(snapshot_path=None)
+        elif name == 'write_kml_file':
+            airports = airfield_scraper.AirportTable.from_records(airfield_scraper.read_airport_files(cache_path=None))
+        with stats.stage(name) as stage:
+            if name == 'read_airport_files':
+                airports = airfield_scraper.AirportTable.from_records(airfield_scraper.read_airport_files(workers=workers, cache_path=None))
+                stage['records'] = len(airports)
+                stage['bytes'] = airfield_scraper.get_files_size([filename for filename in os.listdir('./') if filename.endswith('.htm')])
+            elif name == 'get_bts_airport_list':
+                bts_airports = airfield_scraper.get_bts_airport_list(snapshot_path=None)
+                stage['records'] = len(bts_airports)
+                stage['bytes'] = airfield_scraper.get_files_size(['737306034_T_MASTER_CORD.csv'])
+            elif name == 'get_nfdc_airport_list':
+                nfdc_airports = airfield_scraper.get_nfdc_airport_list(snapshot_path=None)
+                stage['records'] = len(nfdc_airports)
+                stage['bytes'] = airfield_scraper.get_files_size(['APT.txt'])
+            elif name == 'compare_locations':
+                airfield_scraper.compare_locations(nfdc_airports, bts_airports)
+                stage['records'] = len(bts_airports)
+            elif name == 'write_kml_file':
+                airfield_scraper.write_kml_file(airports)
+                stage['records'] = len(airports)
+                stage['bytes'] = airfield_scraper.get_files_size(['abandoned_airports.kml'])
+    connection.send(stats.stages[0])
+
+
+def run_in_child(target, *args):
+    """Run target(*args, connection) in a fresh process and return what it sends back
+
+    Each stage gets a process of its own, so its memory use is not inflated
+    by the fixture generation or the stages that ran before it.
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=target, args=args + (sender,))
+    process.start()
+    #Only the child holds the sending end now, so a crash ends recv instead of hanging
+    sender.close()
+    try:
+        return receiver.recv()
+    except EOFError:
+        raise RuntimeError('{} exited without a result'.format(target.__name__))
+    finally:
+        process.join()
+
+
+def run_benchmarks(scale, seed=0, workers=1, keep=False):
+    """Generate fixtures for scale facilities and return the PipelineStats records of timing each stage"""
+    scratch = tempfile.mkdtemp(prefix='airfield_benchmark_')
+    start_directory = os.getcwd()
+    os.chdir(scratch)
+    try:
+        print('Writing fixtures for {} facilities to {}...'.format(scale, scratch))
+        run_in_child(write_fixtures, scale, seed)
+        return [run_in_child(time_stage, name, workers) for name in benchmark_stages]
+    finally:
+        os.chdir(start_directory)
+        if not keep:
+            shutil.rmtree(scratch)
+
+
+def load_baseline(path=baseline_file):
+    """Return {scale: {stage: measurements}} from earlier runs"""
+    if not os.path.isfile(path):
+        return dict()
+    with open(path, 'r') as baseline:
+        return json.load(baseline)
+
+
+def summarise(records):
+    """Return {stage: measurements} with throughput added"""
+    summary = dict()
+    for record in records:
+        wall_seconds = max(record['wall_seconds'], 1e-9)
+        summary[record['stage']] = {'wall_seconds':record['wall_seconds'],
+                                    'cpu_seconds':record['cpu_seconds'],
+                                    'peak_rss_mb':record['peak_rss_mb'],
+                                    'rss_growth_mb':record['rss_growth_mb'],
+                                    'records':record['records'],
+                                    'records_per_second':(record['records'] or 0)/wall_seconds}
+    return summary
+
+
+def get_change(value, previous):
+    """Return value's change from previous as a signed percentage, blank without a previous value"""
+    if value is None or not previous:
+        return ''
+    return '{:+.1%}'.format(value/previous - 1)
+
+
+def report(records, baseline):
+    """Print each stage's throughput and peak memory next to the baseline run
+
+    Peak MB is the highest resident memory of the stage's own process and its
+    workers, including anything the stage loaded before it started timing.
+    """
+    summary = summarise(records)
+    print('{:<24}{:>10}{:>10}{:>14}{:>14}{:>10}{:>10}{:>13}{:>10}'.format(
+        'Stage', 'Records', 'Seconds', 'Records/s', 'Baseline/s', 'Change', 'Peak MB', 'Baseline MB', 'Change'))
+    for record in records:
+        stage = summary[record['stage']]
+        previous = baseline.get(record['stage']) or dict()
+        print('{:<24}{:>10}{:>10.3f}{:>14.0f}{:>14}{:>10}{:>10}{:>13}{:>10}'.format(
+            record['stage'], stage['records'], stage['wall_seconds'], stage['records_per_second'],
+            '{:.0f}'.format(previous['records_per_second']) if previous.get('records_per_second') else '',
+            get_change(stage['records_per_second'], previous.get('records_per_second')),
+            '{:.1f}'.format(stage['peak_rss_mb']) if stage['peak_rss_mb'] is not None else '-',
+            '{:.1f}'.format(previous['peak_rss_mb']) if previous.get('peak_rss_mb') else '',
+            get_change(stage['peak_rss_mb'], previous.get('peak_rss_mb'))))
+    return summary
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark the airfield pipeline on synthetic data')
+    arg_parser.add_argument('--scale', type=int, default=1000, help='number of facilities in each source (1000 to 1000000)')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--workers', type=int, default=1, help='processes for read_airport_files, 0 for every core')
+    arg_parser.add_argument('--baseline', default=baseline_file, help='json file of stored baseline results')
+    arg_parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline for its scale')
+    arg_parser.add_argument('--keep', action='store_true', help='keep the generated fixtures')
+    args = arg_parser.parse_args()
+
+    records = run_benchmarks(args.scale, seed=args.seed, workers=args.workers or None, keep=args.keep)
+    baselines = load_baseline(args.baseline)
+    summary = report(records, baselines.get(str(args.scale), dict()))
+    if args.save_baseline:
+        baselines[str(args.scale)] = summary
+        airfield_scraper.write_json_file(baselines, args.baseline, indent=1)
+        print('Saved baseline for scale {} to {}.'.format(args.scale, args.baseline))
+
+if __name__ == '__main__':
+    main()
@@ -14,9 +14,35 @@ Latest missing airfield results: https://drive.google.com/open?id=1pEgmk0KaD5EHE
 @author: Wesely
 """
 
-import urllib2
+import httplib
+import urlparse
+import socket
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import itertools
+import operator
+import array
+import collections
+import zipfile
+import functools
+import htmlentitydefs
+import sys
+import time
+import contextlib
+import cProfile
+import argparse
+try:
+    import resource
+except ImportError:
+    #Not available on Windows, peak memory is reported as None there
+    resource = None
+import json
+import hashlib
+import fnmatch
 import re
 import os
+import shutil
 from bs4 import BeautifulSoup
 import datetime
 import glob
@@ -25,6 +51,202 @@ import pprint
 import numpy as np
 
 base_url = "http://www.airfields-freeman.com/"    
+earth_radius_km = 6367
+scrape_manifest_file = "scrape_manifest.json"
+parse_cache_file = "parse_cache.json"
+parser_version = 1
+snapshot_version = 2
+
+#Columns of the BTS Master Coordinate table csv read into airport details
+bts_columns = {
+    'airport_id':1,  #AIRPORT_ID
+    'id':2,          #AIRPORT
+    'airport':3,     #DISPLAY_AIRPORT_NAME
+    'city':4,        #DISPLAY_AIRPORT_CITY_NAME_FULL
+    'country':7,     #AIRPORT_COUNTRY_CODE_ISO
+    'state':9,       #AIRPORT_STATE_CODE
+    'lat':18,        #LATITUDE
+    'lon':23,        #LONGITUDE
+    'start':24,      #AIRPORT_START_DATE
+    'thru':25,       #AIRPORT_THRU_DATE
+    'closed':26,     #AIRPORT_IS_CLOSED
+    'latest':27,     #AIRPORT_IS_LATEST
+}
+
+#Header names of an OurAirports airports.csv file read into airport details
+ourairports_columns = {
+    'id':'ident',
+    'airport':'name',
+    'type':'type',
+    'lat':'latitude_deg',
+    'lon':'longitude_deg',
+    'country':'iso_country',
+    'region':'iso_region',
+    'city':'municipality',
+    'link':'home_link',
+}
+
+#Fixed-width layout of the APT records in the NFDC 28 day subscription APT.txt file
+apt_columns = [
+    ("RECORD TYPE INDICATOR", 0, 3),
+    ("LANDING FACILITY SITE NUMBER", 3, 14),
+    ("LANDING FACILITY TYPE", 14, 27),
+    ("LOCATION IDENTIFIER", 27, 31),
+    ("INFORMATION EFFECTIVE DATE (MM/DD/YYYY)", 31, 41),
+    ("FAA REGION CODE", 41, 44),
+    ("FAA DISTRICT OR FIELD OFFICE CODE", 44, 48),
+    ("ASSOCIATED STATE POST OFFICE CODE", 48, 50),
+    ("ASSOCIATED STATE NAME", 50, 70),
+    ("ASSOCIATED COUNTY (OR PARISH) NAME", 70, 91),
+    ("ASSOCIATED COUNTY'S STATE (POST OFFICE CODE)", 91, 93),
+    ("ASSOCIATED CITY NAME", 93, 133),
+    ("OFFICIAL FACILITY NAME", 133, 183),
+    ("AIRPORT OWNERSHIP TYPE", 183, 185),
+    ("FACILITY USE", 185, 187),
+    ("FACILITY OWNER'S NAME", 187, 222),
+    ("OWNER'S ADDRESS", 222, 294),
+    ("OWNER'S CITY, STATE AND ZIP CODE", 294, 339),
+    ("FACILITY MANAGER'S NAME", 355, 390),
+    ("MANAGER'S ADDRESS", 390, 462),
+    ("MANAGER'S CITY, STATE AND ZIP CODE", 462, 507),
+    ("AIRPORT REFERENCE POINT LATITUDE (FORMATTED)", 523, 538),
+    ("AIRPORT REFERENCE POINT LATITUDE (SECONDS)", 538, 550),
+    ("AIRPORT REFERENCE POINT LONGITUDE (FORMATTED)", 550, 565),
+    ("AIRPORT REFERENCE POINT LONGITUDE (SECONDS)", 565, 577),
+    ("AIRPORT REFERENCE POINT DETERMINATION METHOD", 577, 578),
+    ("AIRPORT ELEVATION DETERMINATION METHOD", 585, 586),
+    ("MAGNETIC VARIATION AND DIRECTION", 586, 589),
+    ("MAGNETIC VARIATION EPOCH YEAR", 589, 593),
+    ("AERONAUTICAL SECTIONAL CHART ON WHICH FACILITY", 597, 627),
+    ("DISTANCE FROM CENTRAL BUSINESS DISTRICT OF", 627, 629),
+    ("DIRECTION OF AIRPORT FROM CENTRAL BUSINESS", 629, 632),
+    ("BOUNDARY ARTCC IDENTIFIER", 637, 641),
+    ("BOUNDARY ARTCC (FAA) COMPUTER IDENTIFIER", 641, 644),
+    ("BOUNDARY ARTCC NAME", 644, 674),
+    ("RESPONSIBLE ARTCC IDENTIFIER", 674, 678),
+    ("RESPONSIBLE ARTCC (FAA) COMPUTER IDENTIFIER", 678, 681),
+    ("RESPONSIBLE ARTCC NAME", 681, 711),
+    ("TIE-IN FSS PHYSICALLY LOCATED ON FACILITY", 711, 712),
+    ("TIE-IN FLIGHT SERVICE STATION (FSS) IDENTIFIER", 712, 716),
+    ("TIE-IN FSS NAME", 716, 746),
+    ("LOCAL PHONE NUMBER FROM AIRPORT TO FSS", 746, 762),
+    ("TOLL FREE PHONE NUMBER FROM AIRPORT TO FSS", 762, 778),
+    ("ALTERNATE FSS IDENTIFIER", 778, 782),
+    ("ALTERNATE FSS NAME", 782, 812),
+    ("TOLL FREE PHONE NUMBER FROM AIRPORT TO", 812, 828),
+    ("IDENTIFIER OF THE FACILITY RESPONSIBLE FOR", 828, 832),
+    ("AVAILABILITY OF NOTAM 'D' SERVICE AT AIRPORT", 832, 833),
+    ("AIRPORT ACTIVATION DATE (MM/YYYY)", 833, 840),
+    ("AIRPORT STATUS CODE", 840, 842),
+    ("AIRPORT ARFF CERTIFICATION TYPE AND DATE", 842, 857),
+    ("NPIAS/FEDERAL AGREEMENTS CODE", 857, 864),
+    ("AIRPORT AIRSPACE ANALYSIS DETERMINATION", 864, 877),
+    ("FACILITY HAS BEEN DESIGNATED BY THE U.S. TREASURY", 877, 878),
+    ("FACILITY HAS BEEN DESIGNATED BY THE U.S. TREASURY", 878, 879),
+    ("FACILITY HAS MILITARY/CIVIL JOINT USE AGREEMENT", 879, 880),
+    ("AIRPORT HAS ENTERED INTO AN AGREEMENT THAT", 880, 881),
+    ("AIRPORT INSPECTION METHOD", 881, 883),
+    ("AGENCY/GROUP PERFORMING PHYSICAL INSPECTION", 883, 884),
+    ("LAST PHYSICAL INSPECTION DATE (MMDDYYYY)", 884, 892),
+    ("LAST DATE INFORMATION REQUEST WAS COMPLETED", 892, 900),
+    ("FUEL TYPES AVAILABLE FOR PUBLIC USE AT THE", 900, 940),
+    ("AIRFRAME REPAIR SERVICE AVAILABILITY/TYPE", 940, 945),
+    ("POWER PLANT (ENGINE) REPAIR AVAILABILITY/TYPE", 945, 950),
+    ("TYPE OF BOTTLED OXYGEN AVAILABLE (VALUE REPRESENTS", 950, 958),
+    ("TYPE OF BULK OXYGEN AVAILABLE (VALUE REPRESENTS", 958, 966),
+    ("AIRPORT LIGHTING SCHEDULE", 966, 973),
+    ("BEACON LIGHTING SCHEDULE", 973, 980),
+    ("AIR TRAFFIC CONTROL TOWER LOCATED ON AIRPORT", 980, 981),
+    ("UNICOM FREQUENCY AVAILABLE AT THE AIRPORT", 981, 988),
+    ("COMMON TRAFFIC ADVISORY FREQUENCY (CTAF)", 988, 995),
+    ("SEGMENTED CIRCLE AIRPORT MARKER SYSTEM ON THE AIRPORT", 995, 999),
+    ("LENS COLOR OF OPERABLE BEACON LOCATED ON THE AIRPORT", 999, 1002),
+    ("LANDING FEE CHARGED TO NON-COMMERCIAL USERS OF", 1002, 1003),
+    ('A "Y" IN THIS FIELD INDICATES THAT THE LANDING', 1003, 1004),
+    ("12-MONTH ENDING DATE ON WHICH ANNUAL OPERATIONS DATA", 1061, 1071),
+    ("AIRPORT POSITION SOURCE", 1071, 1087),
+    ("AIRPORT POSITION SOURCE DATE (MM/DD/YYYY)", 1087, 1097),
+    ("AIRPORT ELEVATION SOURCE", 1097, 1113),
+    ("AIRPORT ELEVATION SOURCE DATE (MM/DD/YYYY)", 1113, 1123),
+    ("CONTRACT FUEL AVAILABLE", 1123, 1124),
+    ("TRANSIENT STORAGE FACILITIES", 1124, 1136),
+    ("OTHER AIRPORT SERVICES AVAILABLE", 1136, 1207),
+    ("WIND INDICATOR", 1207, 1210),
+    ("ICAO IDENTIFIER", 1210, 1217),
+    ("AIRPORT RECORD FILLER (BLANK)", 1217, 1529),
+]
+apt_getter = operator.itemgetter(*[slice(start, end) for name, start, end in apt_columns])
+apt_index = dict((name, i) for i, (name, start, end) in enumerate(apt_columns))
+
+#Airport records on the airfield pages: a line of underscores, the name, then lat/lon
+airport_re = re.compile(r'_+_\s+([^_]{0,200}[)A-Z])\s+(-?\d+[.]?\d+)\s*[NnOoRrTtHh]*\s*[,/]\s*(-?\d+[.]?\d+)\s+(\S+)')
+underscore_run_re = re.compile(r'__+(?=\s)')
+airport_tail_re = re.compile(r'\s+([^_]{0,200}[)A-Z])\s+(-?\d+[.]?\d+)\s*[NnOoRrTtHh]*\s*[,/]\s*(-?\d+[.]?\d+)\s+(\S+)')
+
+#Markup dropped by extract_page_text, like get_text() it skips script and style contents but keeps CDATA
+markup_re = re.compile(r"""<!--.*?-->|<!\[CDATA\[(.*?)\]\]>|<(script|style)\b(?:[^>"']|"[^"]*"|'[^']*')*>.*?</\2\s*>|<[!?][^>]*>|</?[A-Za-z](?:[^>"']|"[^"]*"|'[^']*')*>""", re.S | re.I)
+entity_re = re.compile(r'&(#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z][-.a-zA-Z0-9]*);?')
+charset_re = re.compile(r"""<meta[^>]+charset=["']?([-\w]+)""", re.I)
+html_entities = dict((name, unichr(codepoint)) for name, codepoint in htmlentitydefs.name2codepoint.items())
+html_entities['apos'] = u"'"
+
+#Pre-encoded kml fragments, kml_head takes the document name
+kml_head = '''<?xml version="1.0" encoding="UTF-8"?><kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2" xmlns:kml="http://www.opengis.net/kml/2.2" xmlns:atom="http://www.w3.org/2005/Atom">
+<Document><name>%s</name>
+	<Style id="sh_airports"><IconStyle><scale>1.4</scale><Icon><href>http://maps.google.com/mapfiles/kml/shapes/airports.png</href></Icon><hotSpot x="0.5" y="0" xunits="fraction" yunits="fraction"/></IconStyle><ListStyle></ListStyle></Style>
+	<Style id="sn_airports"><IconStyle><scale>1.2</scale><Icon><href>http://maps.google.com/mapfiles/kml/shapes/airports.png</href></Icon><hotSpot x="0.5" y="0" xunits="fraction" yunits="fraction"/></IconStyle><ListStyle></ListStyle></Style>
+	<StyleMap id="msn_airports"><Pair><key>normal</key><styleUrl>#sn_airports</styleUrl></Pair><Pair><key>highlight</key><styleUrl>#sh_airports</styleUrl></Pair></StyleMap>
+  '''
+kml_tail = '</Document></kml>'
+kml_folder_start = '<Folder><name>%s</name><open>0</open>\n'
+kml_folder_end = '</Folder>\n'
+kml_placemark = '<Placemark><name>%s</name><description><![CDATA[<a href="%s">%s</a>]]></description><styleUrl>#msn_airports</styleUrl><Point><gx:drawOrder>1</gx:drawOrder><coordinates>%s,%s,0</coordinates></Point></Placemark>\n'
+
+#Web Mercator stops short of the poles
+mercator_max_lat = 85.0511287798
+#Loads the tiles written by write_leaflet_tiles, only fetching those in view: airfieldTiles(map, 'leaflet_tiles');
+leaflet_tile_loader = """function airfieldTiles(map, base) {
+    var layer = L.layerGroup().addTo(map), index = null, loaded = {}, shownZoom = null;
+    function tileY(lat, n) {
+        lat = Math.max(-%(max_lat)s, Math.min(%(max_lat)s, lat)) * Math.PI / 180;
+        return Math.floor((1 - Math.log(Math.tan(lat) + 1 / Math.cos(lat)) / Math.PI) / 2 * n);
+    }
+    function tileX(lon, n) {
+        return Math.floor((lon + 180) / 360 * n);
+    }
+    function toLayer(feature, latlng) {
+        var properties = feature.properties;
+        if (properties.cluster) {
+            return L.marker(latlng, {icon: L.divIcon({html: '<b>' + properties.count + '</b>', className: 'airfield-cluster', iconSize: [30, 30]})})
+                .on('click', function () { map.setView(latlng, map.getZoom() + 2); });
+        }
+        return L.marker(latlng).bindPopup('<a href="' + properties.link + '">' + properties.airport + '</a>');
+    }
+    function update() {
+        if (!index) { return; }
+        var zoom = Math.max(index.min_zoom, Math.min(index.max_zoom, map.getZoom()));
+        if (zoom !== shownZoom) { layer.clearLayers(); loaded = {}; shownZoom = zoom; }
+        var n = Math.pow(2, zoom), bounds = map.getBounds(), tiles = index.tiles[zoom] || {};
+        var west = Math.max(0, tileX(bounds.getWest(), n)), east = Math.min(n - 1, tileX(bounds.getEast(), n));
+        var north = Math.max(0, tileY(bounds.getNorth(), n)), south = Math.min(n - 1, tileY(bounds.getSouth(), n));
+        for (var x = west; x <= east; x++) {
+            for (var y = north; y <= south; y++) {
+                var key = x + '/' + y;
+                if (loaded[key] || !tiles[key]) { continue; }
+                loaded[key] = true;
+                (function (tileZoom, key) {
+                    fetch(base + '/' + tileZoom + '/' + key + '.geojson').then(function (response) { return response.json(); }).then(function (data) {
+                        if (tileZoom === shownZoom) { layer.addLayer(L.geoJSON(data, {pointToLayer: toLayer})); }
+                    });
+                })(zoom, key);
+            }
+        }
+    }
+    fetch(base + '/index.json').then(function (response) { return response.json(); }).then(function (data) { index = data; update(); });
+    map.on('moveend', update);
+    return layer;
+}
+""" % {'max_lat':mercator_max_lat}
 
 
 def haversine_np(lon1, lat1, lon2, lat2):
@@ -50,9 +272,477 @@ def haversine_np(lon1, lat1, lon2, lat2):
     a = np.sin(dlat/2.0)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2.0)**2
 
     c = 2 * np.arcsin(np.sqrt(a))
-    km = 6367 * c
+    km = earth_radius_km * c
     return km
-    
+
+
+def haversine_nearest(lat1, lon1, lat2, lon2, max_pairs=4*1024*1024, dtype=np.float64):
+    """
+    Find the closest point in lat2/lon2 for every point in lat1/lon1
+
+    Returns (distances in km, positions in lat2/lon2). Radians and cosines
+    are computed once, and lat1 is processed in blocks of at most max_pairs
+    point pairs so memory stays bounded however many points are compared.
+    dtype=np.float32 halves memory and speeds up the trig at a small cost
+    in precision.
+
+    """
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(values, dtype=np.float64)).astype(dtype) for values in (lat1, lon1, lat2, lon2)]
+    distances = np.full(len(lat1), np.inf)
+    positions = np.full(len(lat1), -1, dtype=np.int64)
+    if not len(lat2):
+        return distances, positions
+    cos_lat1 = np.cos(lat1)
+    cos_lat2 = np.cos(lat2)
+    half = dtype(0.5)
+    rows = max(1, max_pairs//len(lat2))
+    for start in range(0, len(lat1), rows):
+        stop = min(start + rows, len(lat1))
+        #a is monotonic in distance, so only the winners need arcsin
+        a = np.subtract(lat2[np.newaxis, :], lat1[start:stop, np.newaxis])
+        a *= half
+        np.sin(a, out=a)
+        a *= a
+        sin_dlon = np.subtract(lon2[np.newaxis, :], lon1[start:stop, np.newaxis])
+        sin_dlon *= half
+        np.sin(sin_dlon, out=sin_dlon)
+        sin_dlon *= sin_dlon
+        sin_dlon *= cos_lat2[np.newaxis, :]
+        sin_dlon *= cos_lat1[start:stop, np.newaxis]
+        a += sin_dlon
+        closest = np.argmin(a, axis=1)
+        positions[start:stop] = closest
+        distances[start:stop] = 2 * earth_radius_km * np.arcsin(np.sqrt(np.minimum(a[np.arange(stop - start), closest].astype(np.float64), 1.0)))
+    return distances, positions
+
+
+def lat_lon_to_xyz(lat, lon):
+    """Convert decimal degree lat/lon to unit vectors, one row per point"""
+    lat = np.radians(np.atleast_1d(np.asarray(lat, dtype=np.float64)))
+    lon = np.radians(np.atleast_1d(np.asarray(lon, dtype=np.float64)))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat*np.cos(lon), cos_lat*np.sin(lon), np.sin(lat)))
+
+
+def km_to_chord(km):
+    """Convert a great circle distance to the straight line distance between unit vectors"""
+    return 2*np.sin(min(float(km)/earth_radius_km, np.pi)/2.0)
+
+
+def chord_to_km(chord):
+    """Convert the straight line distance between unit vectors to a great circle distance"""
+    return 2*earth_radius_km*np.arcsin(np.minimum(np.asarray(chord)/2.0, 1.0))
+
+
+class AirportIndex(object):
+    """KD-tree over airport locations stored as 3D unit vectors
+
+    The straight line (chord) distance between two unit vectors grows with the
+    great circle distance between them, so the tree can answer nearest and
+    radius queries by pruning whole branches instead of running haversine_np
+    against every airport. Positions returned refer to the lat/lon arrays the
+    index was built from.
+    """
+
+    def __init__(self, lat, lon, leaf_size=32):
+        self.xyz = lat_lon_to_xyz(lat, lon) if len(lat) else np.empty((0, 3))
+        self.leaf_size = leaf_size
+        self.order = np.arange(len(self.xyz))
+        self._build()
+
+    def __len__(self):
+        return len(self.xyz)
+
+    def _build(self):
+        """Split on the widest axis at the median until nodes fit in a leaf"""
+        self.starts, self.ends, self.lows, self.highs = [], [], [], []
+        self.axes, self.splits, self.lefts, self.rights = [], [], [], []
+        pending = [(0, len(self.xyz), None)] if len(self.xyz) else []
+        while pending:
+            start, end, parent_link = pending.pop()
+            node = len(self.starts)
+            if parent_link is not None:
+                getattr(self, parent_link[1])[parent_link[0]] = node
+            points = self.xyz[self.order[start:end]]
+            low = points.min(axis=0)
+            high = points.max(axis=0)
+            self.starts.append(start)
+            self.ends.append(end)
+            self.lows.append(tuple(low))
+            self.highs.append(tuple(high))
+            self.axes.append(-1)
+            self.splits.append(0.0)
+            self.lefts.append(-1)
+            self.rights.append(-1)
+            if end - start <= self.leaf_size:
+                continue
+            axis = int(np.argmax(high - low))
+            middle = (end - start)//2
+            self.order[start:end] = self.order[start:end][np.argpartition(points[:, axis], middle)]
+            self.axes[node] = axis
+            self.splits[node] = float(self.xyz[self.order[start + middle], axis])
+            pending.append((start + middle, end, (node, 'rights')))
+            pending.append((start, start + middle, (node, 'lefts')))
+        self.sorted_xyz = self.xyz[self.order]
+
+    def _box_distance2(self, node, point):
+        """Squared distance from a point to the bounding box of a node"""
+        total = 0.0
+        for value, low, high in zip(point, self.lows[node], self.highs[node]):
+            if value < low:
+                total += (low - value)**2
+            elif value > high:
+                total += (value - high)**2
+        return total
+
+    def _walk(self, point, bound2):
+        """Yield (first position, squared distances) for leaves that may be within bound2"""
+        pending = [0] if self.starts else []
+        while pending:
+            node = pending.pop()
+            if self._box_distance2(node, point) > bound2[0]:
+                continue
+            if self.axes[node] == -1:
+                block = self.sorted_xyz[self.starts[node]:self.ends[node]] - point
+                yield self.starts[node], np.einsum('ij,ij->i', block, block)
+                continue
+            if point[self.axes[node]] < self.splits[node]:
+                pending.extend((self.rights[node], self.lefts[node]))
+            else:
+                pending.extend((self.lefts[node], self.rights[node]))
+
+    def nearest(self, lat, lon, max_dist=None):
+        """Return (distance in km, position) of the closest airport
+
+        When max_dist is given only airports within max_dist km are
+        considered, and (inf, -1) is returned if there are none.
+        """
+        point = tuple(lat_lon_to_xyz(lat, lon)[0])
+        bound2 = [np.inf if max_dist is None else km_to_chord(max_dist)**2]
+        best = -1
+        for start, distances2 in self._walk(point, bound2):
+            closest = int(np.argmin(distances2))
+            if distances2[closest] <= bound2[0]:
+                bound2[0] = float(distances2[closest])
+                best = int(self.order[start + closest])
+        if best == -1:
+            return np.inf, -1
+        return float(chord_to_km(np.sqrt(bound2[0]))), best
+
+    def within(self, lat, lon, radius):
+        """Return the positions of all airports within radius km, closest first"""
+        point = tuple(lat_lon_to_xyz(lat, lon)[0])
+        bound2 = [km_to_chord(radius)**2]
+        positions, distances = [], []
+        for start, distances2 in self._walk(point, bound2):
+            hits = np.nonzero(distances2 <= bound2[0])[0]
+            positions.extend(self.order[start + hits])
+            distances.extend(distances2[hits])
+        return [int(positions[i]) for i in np.argsort(distances, kind='mergesort')]
+
+
+def get_grid_keys(xyz, cell_size):
+    """Return (int64 key of the cube of side cell_size holding each unit vector, cells per axis)
+
+    Raises ValueError when cell_size is not positive or so small that the
+    keys would overflow.
+    """
+    if not cell_size > 0 or (2.0/cell_size + 4)**3 >= 2**62:
+        raise ValueError('Grid cells of {} are too small to key'.format(cell_size))
+    per_axis = int(np.ceil(2.0/cell_size)) + 3
+    cells = np.floor((xyz + 1.0)/cell_size).astype(np.int64)
+    return (cells[:, 0]*per_axis + cells[:, 1])*per_axis + cells[:, 2], per_axis
+
+
+def get_neighbour_offsets(per_axis, reach=1, half=False):
+    """Return key offsets of the cells within reach cells of a cell along every axis
+
+    With half=True only one of each pair of opposite offsets is returned
+    (plus the cell itself), which is enough to visit every pair of cells once.
+    """
+    offsets = []
+    steps = range(-reach, reach + 1)
+    for dx in steps:
+        for dy in steps:
+            for dz in steps:
+                if half and (dx, dy, dz) < (0, 0, 0):
+                    continue
+                offsets.append(((dx, dy, dz), (dx*per_axis + dy)*per_axis + dz))
+    return offsets
+
+
+def expand_cell_pairs(starts1, counts1, starts2, counts2):
+    """Return every (first, second) pairing of the points in matching runs of two cell lists"""
+    sizes = counts1*counts2
+    group = np.repeat(np.arange(len(sizes)), sizes)
+    within = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    return starts1[group] + within//counts2[group], starts2[group] + within % counts2[group]
+
+
+def find_close_pairs(lat, lon, radius):
+    """Return index arrays (first, second) of every pair of points within radius km of each other
+
+    Points are hashed into a grid of cubes as wide as the search radius, so
+    only points in the same or adjacent cubes are ever compared. A radius too
+    small to key a grid on is answered with AirportIndex radius queries.
+    """
+    xyz = lat_lon_to_xyz(lat, lon) if len(lat) else np.empty((0, 3))
+    chord = km_to_chord(radius)
+    try:
+        keys, per_axis = get_grid_keys(xyz, chord)
+    except ValueError:
+        index = AirportIndex(lat, lon)
+        pairs = [(first, second) for first in range(len(lat)) for second in index.within(lat[first], lon[first], radius) if first < second]
+        return np.array([pair[0] for pair in pairs], dtype=np.int64), np.array([pair[1] for pair in pairs], dtype=np.int64)
+    order = np.argsort(keys, kind='mergesort')
+    cell_keys, cell_starts, cell_counts = np.unique(keys[order], return_index=True, return_counts=True)
+    firsts, seconds = [], []
+    for offset, delta in get_neighbour_offsets(per_axis, half=True):
+        targets = np.minimum(np.searchsorted(cell_keys, cell_keys + delta), max(len(cell_keys) - 1, 0))
+        matched = np.nonzero(cell_keys[targets] == cell_keys + delta)[0] if len(cell_keys) else targets
+        first, second = expand_cell_pairs(cell_starts[matched], cell_counts[matched], cell_starts[targets[matched]], cell_counts[targets[matched]])
+        first, second = order[first], order[second]
+        if offset == (0, 0, 0):
+            keep = first < second
+            first, second = first[keep], second[keep]
+        difference = xyz[first] - xyz[second]
+        close = np.einsum('ij,ij->i', difference, difference) <= chord**2
+        firsts.append(first[close])
+        seconds.append(second[close])
+    if not firsts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+class AirportGrid(object):
+    """Grid of cubes over airport locations for "is any airport within radius km" checks
+
+    Airports are stored as unit vectors sorted by the cube holding them,
+    with cubes whose diagonal is the chord of radius, so any airport in the
+    same cube as a query point is close enough without working out a
+    distance. Only cubes up to two steps away along each axis can hold a
+    match: those that cannot reach the query point are skipped, those that
+    lie entirely within reach of it answer yes when occupied, and only the
+    airports of the remaining borderline cubes are measured. The chord
+    comparison is exact, it orders points the same way as haversine_np.
+    """
+
+    def __init__(self, lat, lon, radius):
+        self._set_radius(radius)
+        xyz = lat_lon_to_xyz(lat, lon) if len(lat) else np.empty((0, 3))
+        keys, _ = get_grid_keys(xyz, self.cell_size)
+        self.order = np.argsort(keys, kind='mergesort')
+        self.xyz = xyz[self.order]
+        self.cell_keys, self.cell_starts, self.cell_counts = np.unique(keys[self.order], return_index=True, return_counts=True)
+
+    def _set_radius(self, radius):
+        """Work out the cube size and neighbour offsets for radius, raising ValueError if it is too small to key"""
+        self.radius = float(radius)
+        self.chord = km_to_chord(self.radius)
+        self.cell_size = self.chord/np.sqrt(3)
+        _, self.per_axis = get_grid_keys(np.empty((0, 3)), self.cell_size)
+        self.offsets = get_neighbour_offsets(self.per_axis, reach=2)
+
+    def __len__(self):
+        return len(self.xyz)
+
+    def contains_within(self, lat, lon, chunk_size=1024):
+        """Return a boolean array, True where an airport lies within radius km of each point
+
+        Points are first checked against their own cube alone, then the
+        neighbouring cubes of those left over are looked up chunk_size points
+        at a time.
+        """
+        xyz = lat_lon_to_xyz(lat, lon)
+        found = np.zeros(len(xyz), dtype=bool)
+        if not len(self.cell_keys) or not len(xyz):
+            return found
+        keys, _ = get_grid_keys(xyz, self.cell_size)
+        last = len(self.cell_keys) - 1
+        found[self.cell_keys[np.minimum(np.searchsorted(self.cell_keys, keys), last)] == keys] = True
+        pending = np.nonzero(~found)[0]
+
+        #Position of each point inside its own cube, from 0 to 1 along each axis
+        scaled = (xyz[pending] + 1.0)/self.cell_size
+        inside = scaled - np.floor(scaled)
+        #Squared reach in cube widths, with a little slack for rounding either way
+        reach2 = (self.chord/self.cell_size)**2
+        steps = np.array([offset for offset, delta in self.offsets if delta != 0], dtype=np.float64)
+        deltas = np.array([delta for offset, delta in self.offsets if delta != 0], dtype=np.int64)
+        for start in range(0, len(pending), chunk_size):
+            position = inside[start:start + chunk_size, np.newaxis, :]
+            gap = np.maximum(np.maximum(steps - position, position - steps - 1.0), 0.0)
+            query, offset = np.nonzero(np.einsum('ijk,ijk->ij', gap, gap) <= reach2*(1 + 1e-9))
+            query += start
+            wanted = keys[pending[query]] + deltas[offset]
+            cells = np.minimum(np.searchsorted(self.cell_keys, wanted), last)
+            occupied = self.cell_keys[cells] == wanted
+            query, offset, cells = query[occupied], offset[occupied], cells[occupied]
+            #Cubes lying wholly within reach answer yes once occupied, the rest need their airports measured
+            far = np.maximum(np.abs(steps[offset] + 1.0 - inside[query]), np.abs(steps[offset] - inside[query]))
+            certain = np.einsum('ij,ij->i', far, far) <= reach2*(1 - 1e-9)
+            found[pending[query[certain]]] = True
+            unsure = ~certain & ~found[pending[query]]
+            query, cells = pending[query[unsure]], cells[unsure]
+            if len(query):
+                query, point = expand_cell_pairs(query, np.ones(len(query), dtype=np.int64), self.cell_starts[cells], self.cell_counts[cells])
+                difference = xyz[query] - self.xyz[point]
+                found[query[np.einsum('ij,ij->i', difference, difference) <= self.chord**2]] = True
+        return found
+
+    @classmethod
+    def load(cls, path):
+        """Read a grid written by save, returning (grid, source tag)
+
+        The sorted airports and cube lists are read back as saved, so loading
+        skips the sort that building a grid needs.
+        """
+        with np.load(path) as saved:
+            grid = cls.__new__(cls)
+            grid._set_radius(saved['radius'])
+            for name in cls.saved_arrays:
+                setattr(grid, name, saved[name])
+            source_tag = json.loads(saved['source_tag'].item())
+        return grid, source_tag
+
+    saved_arrays = ('xyz', 'order', 'cell_keys', 'cell_starts', 'cell_counts')
+
+    def save(self, path, source_tag=None):
+        """Write the grid to an uncompressed .npz file along with a description of its source"""
+        arrays = dict((name, getattr(self, name)) for name in self.saved_arrays)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as grid_file:
+            np.savez(grid_file, radius=np.array(self.radius), source_tag=np.array(json.dumps(source_tag or dict())), **arrays)
+        replace_file(temp_path, path)
+
+
+class AirportTable(object):
+    """Columnar store of airport details
+
+    Latitudes and longitudes are float64 arrays. Text columns (airport,
+    state, id, link, ...) are stored as int32 codes into a list of distinct
+    values, so a value repeated across thousands of airports is kept once.
+    Iterating a table or indexing it with an integer yields the same dicts
+    the readers build, so code written for lists of airports accepts a table
+    unchanged. Readers that give coordinates as text, like the website pages,
+    have that text kept in lat_text and lon_text and handed back as lat and
+    lon, so output shows them exactly as read. Code 0 of every text column is
+    reserved for a missing value.
+    """
+    text_columns = ('airport', 'state', 'city', 'start', 'thru', 'closed', 'id', 'airport_id', 'link', 'lat_text', 'lon_text')
+    #Text columns holding the coordinates as the reader gave them, by the key they came from
+    coordinate_text_columns = {'lat_text':'lat', 'lon_text':'lon'}
+
+    def __init__(self, lat, lon, codes, categories):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.codes = codes
+        self.categories = categories
+        self.columns = tuple(column for column in self.text_columns if column in codes)
+
+    @classmethod
+    def from_records(cls, airports):
+        """Build a table from an iterable of airport dicts in a single pass"""
+        lat = array.array('d')
+        lon = array.array('d')
+        codes = dict()
+        lookups = dict()
+        categories = dict()
+        for count, airport in enumerate(airports):
+            lat.append(float(airport.get('lat')))
+            lon.append(float(airport.get('lon')))
+            for column in cls.text_columns:
+                if column in cls.coordinate_text_columns:
+                    value = airport.get(cls.coordinate_text_columns[column])
+                    value = None if isinstance(value, float) else value
+                    present = value is not None
+                else:
+                    value = airport.get(column)
+                    present = column in airport
+                if column not in codes:
+                    if not present:
+                        continue
+                    #Airports read before this column first appeared have no value for it
+                    codes[column] = array.array('i', [0]*count)
+                    lookups[column] = {None:0}
+                    categories[column] = [None]
+                lookup = lookups[column]
+                code = lookup.get(value)
+                if code is None:
+                    code = lookup[value] = len(categories[column])
+                    categories[column].append(value)
+                codes[column].append(code)
+        codes = dict((column, np.frombuffer(values, dtype=np.int32) if len(values) else np.zeros(0, dtype=np.int32)) for column, values in codes.items())
+        return cls(np.frombuffer(lat, dtype=np.float64) if len(lat) else np.zeros(0),
+                   np.frombuffer(lon, dtype=np.float64) if len(lon) else np.zeros(0),
+                   codes, categories)
+
+    @classmethod
+    def load(cls, path):
+        """Read a table written by save, returning (table, source tag)"""
+        with np.load(path) as snapshot:
+            columns = [name[len('codes_'):] for name in snapshot.files if name.startswith('codes_')]
+            codes = dict((column, snapshot['codes_' + column]) for column in columns)
+            categories = dict((column, [None] + snapshot['categories_' + column].tolist()) for column in columns)
+            source_tag = json.loads(snapshot['source_tag'].item())
+            table = cls(snapshot['lat'], snapshot['lon'], codes, categories)
+        return table, source_tag
+
+    def save(self, path, source_tag=None):
+        """Write the table to an uncompressed .npz file along with a description of its source"""
+        arrays = {'lat':self.lat, 'lon':self.lon, 'source_tag':np.array(json.dumps(source_tag or dict()))}
+        for column in self.columns:
+            arrays['codes_' + column] = self.codes[column]
+            arrays['categories_' + column] = np.array(self.categories[column][1:], dtype=np.string_)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as snapshot_file:
+            np.savez(snapshot_file, **arrays)
+        replace_file(temp_path, path)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def __iter__(self):
+        columns = [(column, self.codes[column], self.categories[column]) for column in self.columns]
+        for position in range(len(self.lat)):
+            airport = {'lat':float(self.lat[position]), 'lon':float(self.lon[position])}
+            for column, codes, categories in columns:
+                self._set_value(airport, column, categories[codes[position]])
+            yield airport
+
+    def _set_value(self, airport, column, value):
+        """Put a text column's value into an airport dict, coordinate text replacing the float it was read as"""
+        if column not in self.coordinate_text_columns:
+            airport[column] = value
+        elif value is not None:
+            airport[self.coordinate_text_columns[column]] = value
+
+    def __getitem__(self, key):
+        """An integer returns one airport dict; a slice, index array or boolean mask returns a table"""
+        if isinstance(key, (int, long, np.integer)):
+            airport = {'lat':float(self.lat[key]), 'lon':float(self.lon[key])}
+            for column in self.columns:
+                self._set_value(airport, column, self.categories[column][self.codes[column][key]])
+            return airport
+        #Slices give views of the columns, categories are shared rather than copied
+        return AirportTable(self.lat[key], self.lon[key],
+                            dict((column, codes[key]) for column, codes in self.codes.items()),
+                            self.categories)
+
+    def coordinates(self):
+        """Return the (lat, lon) arrays themselves, without copying"""
+        return self.lat, self.lon
+
+    def get_column(self, column):
+        """Return the values of a text column as a list"""
+        categories = self.categories[column]
+        return [categories[code] for code in self.codes[column]]
+
+    def filter_state(self, *states):
+        """Return the airports in any of the given states"""
+        wanted = [code for code, state in enumerate(self.categories['state']) if state in states]
+        return self[np.in1d(self.codes['state'], wanted)]
+
 
 def get_link_from_html(text):
     """Parse href link text out of html text"""
@@ -69,8 +759,17 @@ def get_mdyyyy_from_text(text):
     return update_date
 
 
-def get_latest_file(string):
-    """Look for matching files and return the most recent"""
+def get_latest_file(string, file_dates=None):
+    """Look for matching files and return the most recent
+
+    Pass file_dates from get_local_file_dates to match against one directory
+    listing instead of globbing the disk for every lookup.
+    """
+    if file_dates is not None:
+        sorted_dates = sorted([file_dates[item] for item in fnmatch.filter(file_dates, string)])
+        if sorted_dates:
+            return sorted_dates[-1]
+        return datetime.date(1, 1, 1)
     files = filter(os.path.isfile, glob.glob('./' + string))
     sorted_dates = sorted([os.path.getmtime(item) for item in files])
     if sorted_dates:
@@ -78,75 +777,301 @@ def get_latest_file(string):
     return datetime.date(1, 1, 1)
 
 
-def scrape_airports():
-    """Download new files from Abandoned Airfields website"""
-    #Checks update times, compares to file dates, only downloads updated pages
+def get_local_file_dates(path='./'):
+    """Return {filename: modified date} for every file in a directory"""
+    file_dates = dict()
+    for filename in os.listdir(path):
+        full_path = os.path.join(path, filename)
+        if os.path.isfile(full_path):
+            file_dates[filename] = datetime.datetime.fromtimestamp(os.path.getmtime(full_path)).date()
+    return file_dates
+
+
+def get_listed_pages(html):
+    """Return [(link, update date), ...] for the table cells of a listing page, None if it has no table"""
+    cells = BeautifulSoup(html, 'html.parser').find_all('td')
+    if not cells:
+        return None
+    listed = []
+    for cell in cells:
+        try:
+            link = get_link_from_html(repr(cell))
+        except IndexError:
+            print("No link in this cell, skipping. This should be fine.")
+            continue
+        listed.append((link, get_mdyyyy_from_text(repr(cell))))
+    return listed
+
+
+def load_scrape_manifest(path=scrape_manifest_file):
+    """Load the record of previously fetched pages, keyed by url"""
+    if not os.path.isfile(path):
+        return dict()
+    with open(path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_json_file(data, path, indent=None):
+    """Write data as json, replacing the old file only once the new one is complete"""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as json_file:
+        json.dump(data, json_file, indent=indent, sort_keys=True)
+    replace_file(temp_path, path)
+
+
+def replace_file(temp_path, path):
+    """Move a completely written temp_path over path"""
+    #os.rename won't replace an existing file on Windows
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(temp_path, path)
+
+
+def save_scrape_manifest(manifest, path=scrape_manifest_file):
+    """Write the record of fetched pages"""
+    write_json_file(manifest, path, indent=1)
+
+
+class PageFetcher(object):
+    """Conditional GET requests over reused keep-alive connections
+
+    Each worker thread keeps one connection per host, at most per_host
+    requests run against a host at once, and pages already in the manifest
+    are requested with If-None-Match/If-Modified-Since so unchanged pages
+    come back as an empty 304.
+    """
+
+    def __init__(self, manifest, per_host=4, timeout=30):
+        self.manifest = manifest
+        self.per_host = per_host
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.host_limits = dict()
+        self.connections = []
+        self.local = threading.local()
+        self.total_downloaded = 0
+
+    def _host_limit(self, host):
+        with self.lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.Semaphore(self.per_host)
+            return self.host_limits[host]
+
+    def _connection(self, scheme, host, fresh=False):
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = dict()
+        key = (scheme, host)
+        if fresh and key in self.local.connections:
+            self.local.connections.pop(key).close()
+        if key not in self.local.connections:
+            connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+            connection = connection_class(host, timeout=self.timeout)
+            self.local.connections[key] = connection
+            with self.lock:
+                self.connections.append(connection)
+        return self.local.connections[key]
+
+    def _request(self, url, headers):
+        """GET url on a kept-alive connection, returning (response, body)"""
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = '{}?{}'.format(path, parts.query)
+        with self._host_limit(parts.netloc):
+            for attempt in range(2):
+                #A kept-alive connection may have been dropped by the server, retry once on a new one
+                connection = self._connection(parts.scheme, parts.netloc, fresh=attempt > 0)
+                try:
+                    connection.request('GET', path, headers=headers)
+                    response = connection.getresponse()
+                    page = response.read()
+                    break
+                except (httplib.HTTPException, socket.error):
+                    if attempt:
+                        raise
+        return response, page
+
+    def fetch(self, url, max_redirects=5):
+        """Return the page body, or None if it has not changed since the last fetch
+
+        301, 302, 307 and 308 redirects are followed up to max_redirects
+        times, and the address the page finally came from is recorded in the
+        manifest as final_url.
+        """
+        entry = self.manifest.get(url, dict())
+        headers = dict()
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        final_url = url
+        for hop in range(max_redirects + 1):
+            response, page = self._request(final_url, headers)
+            if response.status not in (301, 302, 307, 308):
+                break
+            location = response.getheader('location')
+            if not location:
+                raise IOError('{} returned HTTP {} without a Location'.format(final_url, response.status))
+            final_url = urlparse.urljoin(final_url, location)
+        else:
+            raise IOError('{} redirected more than {} times'.format(url, max_redirects))
+        if response.status == 304:
+            return None
+        if response.status != 200:
+            raise IOError('{} returned HTTP {}'.format(url, response.status))
+        with self.lock:
+            self.total_downloaded = self.total_downloaded + len(page)
+            self.manifest[url] = {'etag':response.getheader('etag'),
+                                  'last_modified':response.getheader('last-modified'),
+                                  'final_url':final_url,
+                                  'fetched':datetime.datetime.now().isoformat()}
+        return page
+
+    def update(self, url, **fields):
+        """Record extra details about a fetched page in the manifest"""
+        with self.lock:
+            self.manifest.setdefault(url, dict()).update(fields)
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+
+
+def get_listed_date(manifest, url, pattern, file_dates):
+    """Return the listing date of the last download of url, falling back to local file dates
+
+    A page left incomplete by failed downloads counts as never downloaded.
+    """
+    if manifest.get(url, dict()).get('incomplete'):
+        return datetime.date(1, 1, 1)
+    listed_date = manifest.get(url, dict()).get('listed_date')
+    if listed_date:
+        return datetime.datetime.strptime(listed_date, '%Y-%m-%d').date()
+    return get_latest_file(pattern, file_dates)
+
+
+def get_listing(fetcher, url):
+    """Fetch a listing page, reusing the manifest's copy of its links if it is unchanged"""
+    page = fetcher.fetch(url)
+    if page is None:
+        listed = fetcher.manifest[url].get('listed')
+        if listed is None:
+            return page, None
+        return page, [(link, datetime.datetime.strptime(date, '%Y-%m-%d').date()) for link, date in listed]
+    listed = get_listed_pages(page)
+    if listed is None:
+        fetcher.update(url, listed=None)
+    else:
+        fetcher.update(url, listed=[(link, date.isoformat()) for link, date in listed])
+    return page, listed
+
+
+def scrape_state(fetcher, base, state, state_file, update_date, file_dates):
+    """Fetch a state page and return (state url, the region pages that need downloading)
+
+    A state with regions to download is only marked as checked by
+    scrape_airports once all of them have been downloaded, so a failed
+    region is tried again on the next run.
+    """
+    state_url = '{}{}/{}'.format(base, state, state_file)
+    try:
+        state_page, region_cells = get_listing(fetcher, state_url)
+    except (IOError, httplib.HTTPException, socket.error):
+        print('Error downloading {}, skipping.'.format(state_url))
+        return state_url, None
+    if region_cells is None:
+        #No cells here, must be a state without separate regions
+        if state_page is not None:
+            airport_file = open('./{}'.format(state_file),'wb')
+            airport_file.write(state_page)
+            airport_file.close()
+        fetcher.update(state_url, listed_date=update_date.isoformat())
+        return state_url, []
+
+    regions = []
+    for region_link, region_date in region_cells:
+        region_url = '{}{}/{}'.format(base, state, region_link)
+        local_date = get_listed_date(fetcher.manifest, region_url, region_link, file_dates)
+        print('{} last updated {}, local version updated {}'.format(region_link,region_date,local_date))
+        if region_date > local_date:
+            regions.append((region_url, region_link, region_date))
+    if not regions:
+        fetcher.update(state_url, listed_date=update_date.isoformat())
+    return state_url, regions
+
+
+def scrape_region(fetcher, region_url, region_link, region_date):
+    """Download a region page unless the server reports it unchanged, returning whether it succeeded"""
+    print(region_url)
+    try:
+        region_page = fetcher.fetch(region_url)
+        if region_page is None and not os.path.isfile(region_link):
+            #Server says unchanged but the local copy is gone, ask again unconditionally
+            fetcher.update(region_url, etag=None, last_modified=None)
+            region_page = fetcher.fetch(region_url)
+            if region_page is None:
+                raise IOError('no page returned for an unconditional request')
+    except (IOError, httplib.HTTPException, socket.error) as e:
+        print('Error downloading {}, skipping. {}'.format(region_url, e))
+        return False
+    if region_page is not None:
+        airport_file = open('./{}'.format(region_link),'wb')
+        airport_file.write(region_page)
+        airport_file.close()
+    fetcher.update(region_url, listed_date=region_date.isoformat())
+    return True
+
+
+def scrape_airports(base=base_url, workers=8, per_host=4, manifest_path=scrape_manifest_file):
+    """Download new files from Abandoned Airfields website
+
+    State and region pages are fetched by a pool of worker threads with
+    conditional requests, and scrape_manifest.json remembers what was fetched
+    so a run with no site changes costs a single request for the home page.
+    """
+    #Checks update times, compares to the manifest and file dates, only downloads updated pages
     #TODO: Check robots.txt to see if it was changed to disallow robots
     print('Checking for updated files...')
-    total_downloaded = 0
-    response  = urllib2.urlopen(base_url)
-    home_page = response.read()
-    total_downloaded = total_downloaded + len(home_page)
-    #links     = re.findall('HREF="([^.]+).htm"',home_page)
-    #print(links)
-    
-    home_soup = BeautifulSoup(home_page, 'html.parser')
-    state_cells = home_soup.find_all('td')
-    
-    #check this state for updates
-    for state_cell in state_cells:
-        #print(state_cell)
-        deep_link = get_link_from_html(repr(state_cell))
-        state,state_file = deep_link.split('/')
-        
-        update_date = get_mdyyyy_from_text(repr(state_cell))
-        
-        local_date = get_latest_file(state_file.replace('.htm','*.htm'))
+    manifest = load_scrape_manifest(manifest_path)
+    fetcher = PageFetcher(manifest, per_host=per_host)
+    file_dates = get_local_file_dates()
+    pool = ThreadPool(workers)
+    try:
+        home_page, state_cells = get_listing(fetcher, base)
 
-        #print('{} last updated {}, local version updated {}'.format(deep_link,update_date,local_date))
-        
-        if update_date > local_date:
-            print('{} last updated {}, local version updated {}'.format(deep_link,update_date,local_date))
-            this_link  = '{}{}'.format(base_url,deep_link)
-            response   = urllib2.urlopen(this_link)
-            state_page = response.read()
-            total_downloaded = total_downloaded + len(state_page)
-            
-            state_soup = BeautifulSoup(state_page, 'html.parser')
-            region_cells = state_soup.find_all('td')
-            if not region_cells:
-                #No cells here, must be a state without separate regions
-                airport_file = open('./{}'.format(state_file),'w')
-                airport_file.write(state_page)
-                airport_file.close()
+        #check each state for updates
+        states = []
+        for deep_link, update_date in state_cells or []:
+            state,state_file = deep_link.split('/')
+            local_date = get_listed_date(manifest, '{}{}'.format(base, deep_link), state_file.replace('.htm','*.htm'), file_dates)
+            #print('{} last updated {}, local version updated {}'.format(deep_link,update_date,local_date))
+            if update_date > local_date:
+                print('{} last updated {}, local version updated {}'.format(deep_link,update_date,local_date))
+                states.append((state, state_file, update_date))
+
+        checked_states = []
+        for job, (state_url, state_regions) in zip(states, pool.imap(lambda job: scrape_state(fetcher, base, job[0], job[1], job[2], file_dates), states)):
+            checked_states.append((state_url, job[2], state_regions))
+        regions = [region for state_url, update_date, state_regions in checked_states for region in state_regions or []]
+        downloaded = dict(zip([region[0] for region in regions], pool.map(lambda job: scrape_region(fetcher, *job), regions)))
+        for state_url, update_date, state_regions in checked_states:
+            if not state_regions:
                 continue
-                
-            #check this state for updates
-            for region_cell in region_cells:
-                #print(region_cell)
-                try:
-                    region_link = get_link_from_html(repr(region_cell))
-                except:
-                    print("No link in this cell, skipping. This should be fine.")
-                    continue
-                update_date = get_mdyyyy_from_text(repr(region_cell))
-                
-                local_date = get_latest_file(region_link)
-                print('{} last updated {}, local version updated {}'.format(region_link,update_date,local_date))
-                if update_date > local_date:
-                    this_deep_link = '{}{}/{}'.format(base_url,state,region_link)
-                    print(this_deep_link)
-                    try:
-                        response     = urllib2.urlopen(this_deep_link)
-                    except:
-                        print('Error downloading, skipping.')
-                        continue
-                    region_page  = response.read()
-                    total_downloaded = total_downloaded + len(region_page)
-                    airport_file = open('./{}'.format(region_link),'w')
-                    airport_file.write(region_page)
-                    airport_file.close()
-    print('Downloaded {:.2}MB, please donate at {} to help with bandwidth costs!'.format(total_downloaded/(1024*1024.0),base_url))
+            if all(downloaded[region[0]] for region in state_regions):
+                fetcher.update(state_url, listed_date=update_date.isoformat(), incomplete=False)
+            else:
+                fetcher.update(state_url, incomplete=True)
+                print('Some regions of {} failed, it will be checked again next run.'.format(state_url))
+    finally:
+        pool.close()
+        pool.join()
+        fetcher.close()
+        save_scrape_manifest(manifest, manifest_path)
+    total_downloaded = fetcher.total_downloaded
+    print('Downloaded {:.2}MB, please donate at {} to help with bandwidth costs!'.format(total_downloaded/(1024*1024.0),base))
+    return total_downloaded
 
 
 def write_leaflet_file(items):
@@ -157,315 +1082,1297 @@ def write_leaflet_file(items):
         leaflet_output_file.write("L.marker([{}, {}]).addTo(map)\n    .bindPopup('<a href=\"{}\">{}</a>')\n    .openPopup();\n".format(item.get('lat'),item.get('lon'),item.get('link'),item.get('airport')))
     leaflet_output_file.close()
     print('Done writing leaflet file.')
-    
-    
-def write_kml_file(items,base_name='abandoned_airports'):
-    """Write Google Earth kml file to import into Google Maps"""
-    print('Writing kml files...')
-    kml_output_file = open('./%s.kml'%base_name,'w')
-    kml_head = '''<?xml version="1.0" encoding="UTF-8"?><kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2" xmlns:kml="http://www.opengis.net/kml/2.2" xmlns:atom="http://www.w3.org/2005/Atom">
-<Document><name>%s</name>
-	<Style id="sh_airports"><IconStyle><scale>1.4</scale><Icon><href>http://maps.google.com/mapfiles/kml/shapes/airports.png</href></Icon><hotSpot x="0.5" y="0" xunits="fraction" yunits="fraction"/></IconStyle><ListStyle></ListStyle></Style>
-	<Style id="sn_airports"><IconStyle><scale>1.2</scale><Icon><href>http://maps.google.com/mapfiles/kml/shapes/airports.png</href></Icon><hotSpot x="0.5" y="0" xunits="fraction" yunits="fraction"/></IconStyle><ListStyle></ListStyle></Style>
-	<StyleMap id="msn_airports"><Pair><key>normal</key><styleUrl>#sn_airports</styleUrl></Pair><Pair><key>highlight</key><styleUrl>#sh_airports</styleUrl></Pair></StyleMap>
-  '''%base_name
-    kml_output_file.write(kml_head)
-    recorded_states = dict()
-    sorted_items = sorted(zip([item.get('state') for item in items],items))
-    
 
-    for state,item in sorted_items:
-        if recorded_states and state not in recorded_states:
-            kml_output_file.write('</Folder>\n')
-            
-            kml_state_output_file.write('</Folder>\n')
-            kml_state_output_file.write('</Document></kml>')
-            kml_state_output_file.close()
-        if state not in recorded_states:
-            kml_output_file.write('<Folder><name>{}</name><open>0</open>\n'.format(state))
-            recorded_states[state] = 1
-    
-            kml_state_output_file = open('./{}_{}.kml'.format(base_name,state),'w')
-            kml_state_output_file.write(kml_head)
-            kml_state_output_file.write('<Folder><name>{}</name><open>0</open>\n'.format(state))
+
+def get_mercator_coordinates(lat, lon):
+    """Return Web Mercator x and y of each point as fractions of the map, from 0 at the north west corner to just under 1"""
+    lat = np.radians(np.clip(lat, -mercator_max_lat, mercator_max_lat))
+    x = (np.asarray(lon, dtype=np.float64) + 180.0)/360.0
+    y = (1.0 - np.log(np.tan(lat) + 1.0/np.cos(lat))/np.pi)/2.0
+    return np.clip(x, 0, 1 - 1e-12), np.clip(y, 0, 1 - 1e-12)
+
+
+def get_point_feature(lat, lon, properties):
+    """Return a GeoJSON point feature"""
+    return {'type':'Feature',
+            'geometry':{'type':'Point', 'coordinates':[round(float(lon), 6), round(float(lat), 6)]},
+            'properties':properties}
+
+
+def write_leaflet_tiles(items, out_dir='./leaflet_tiles', max_zoom=10, cluster_zoom=8, cluster_cells=8):
+    """Write lat/lon items as a quadtree of GeoJSON tiles for a leaflet map to fetch as it pans
+
+    Tiles follow the z/x/y layout of the map's own base layers, written only
+    where they hold something. Below cluster_zoom each tile is split into a
+    cluster_cells by cluster_cells grid and every cell holding more than one
+    item becomes a single cluster feature with a count, so no tile holds more
+    than cluster_cells squared features. From cluster_zoom up every item is its
+    own feature, and past max_zoom the map keeps using the max_zoom tiles.
+    index.json lists the tiles per zoom so the map never asks for empty ones,
+    and leaflet_tiles.js holds the loader. Returns the number of tiles written.
+    """
+    print('Writing leaflet tiles...')
+    lat, lon = get_lat_lon_from_list(items)
+    x, y = get_mercator_coordinates(lat, lon)
+    properties = [{'airport':item.get('airport'), 'link':item.get('link')} for item in items]
+    #Only clear out a directory this function wrote before
+    if os.path.isfile(os.path.join(out_dir, 'index.json')):
+        shutil.rmtree(out_dir)
+    index = {'min_zoom':0, 'max_zoom':max_zoom, 'cluster_zoom':cluster_zoom, 'tiles':dict()}
+    for zoom in range(max_zoom + 1):
+        if zoom < cluster_zoom:
+            cells = 2**zoom*cluster_cells
+            cell_x = (x*cells).astype(np.int64)
+            cell_y = (y*cells).astype(np.int64)
+            keys, first, inverse, counts = np.unique(cell_x*cells + cell_y, return_index=True, return_inverse=True, return_counts=True)
+            cluster_lat = np.bincount(inverse, weights=lat)/counts
+            cluster_lon = np.bincount(inverse, weights=lon)/counts
+            features = [get_point_feature(lat[position], lon[position], properties[position]) if count == 1 else
+                        get_point_feature(cluster_lat[cell], cluster_lon[cell], {'cluster':True, 'count':int(count)})
+                        for cell, (position, count) in enumerate(zip(first, counts))]
+            tile_x = cell_x[first]//cluster_cells
+            tile_y = cell_y[first]//cluster_cells
         else:
-            recorded_states[state] = recorded_states[state] + 1
-        placemark = '<Placemark><name>{}</name><description><![CDATA[<a href="{}">{}</a>]]></description><styleUrl>#msn_airports</styleUrl><Point><gx:drawOrder>1</gx:drawOrder><coordinates>{},{},0</coordinates></Point></Placemark>\n'.format(item.get('airport').replace('&',' and '),item.get('link'),'Link',item.get('lon'),item.get('lat'))
-        kml_output_file.write(placemark)
-        kml_state_output_file.write(placemark)
-    kml_output_file.write('</Folder>\n')
-    kml_output_file.write('</Document></kml>')
-
-    kml_output_file.close()
+            features = [get_point_feature(lat[position], lon[position], properties[position]) for position in range(len(lat))]
+            tile_x = (x*2**zoom).astype(np.int64)
+            tile_y = (y*2**zoom).astype(np.int64)
+        tile_keys = tile_x*2**zoom + tile_y
+        order = np.argsort(tile_keys, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(tile_keys[order])) + 1
+        zoom_tiles = index['tiles'][zoom] = dict()
+        for tile in np.split(order, bounds):
+            if not len(tile):
+                continue
+            key = '{}/{}'.format(tile_x[tile[0]], tile_y[tile[0]])
+            tile_dir = os.path.join(out_dir, str(zoom), str(tile_x[tile[0]]))
+            if not os.path.isdir(tile_dir):
+                os.makedirs(tile_dir)
+            with open(os.path.join(tile_dir, '{}.geojson'.format(tile_y[tile[0]])), 'w') as tile_file:
+                json.dump({'type':'FeatureCollection', 'features':[features[position] for position in tile]}, tile_file, separators=(',', ':'))
+            zoom_tiles[key] = len(tile)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    write_json_file(index, os.path.join(out_dir, 'index.json'))
+    with open(os.path.join(out_dir, 'leaflet_tiles.js'), 'w') as loader_file:
+        loader_file.write(leaflet_tile_loader)
+    tile_count = sum(len(zoom_tiles) for zoom_tiles in index['tiles'].values())
+    print('Done writing {} leaflet tiles.'.format(tile_count))
+    return tile_count
+
+    
+class KmlWriter(object):
+    """Stream placemarks into a combined kml file and one kml file per state
+
+    Placemarks are built from pre-encoded template fragments, buffered per
+    state and appended to that state's file in batches, with at most
+    max_open_files state files open at once. Items need not arrive sorted.
+    On close the combined file is assembled from the state files with one
+    folder per state in sorted order, and with kmz=True every file is packed
+    into a compressed .kmz archive instead of being left as plain kml.
+    """
+
+    def __init__(self, base_name='abandoned_airports', kmz=False, max_open_files=16, batch_size=1000):
+        self.base_name = base_name
+        self.kmz = kmz
+        self.max_open_files = max_open_files
+        self.batch_size = batch_size
+        self.head = kml_head % base_name
+        self.recorded_states = dict()
+        self.pending = dict()
+        self.started = set()
+        self.open_files = collections.OrderedDict()
+
+    def state_path(self, state):
+        return './{}_{}.kml'.format(self.base_name, state)
+
+    def add(self, item):
+        """Queue one airport's placemark, writing its state's batch when it is full"""
+        state = item.get('state')
+        if state not in self.recorded_states:
+            self.recorded_states[state] = 0
+            self.pending[state] = [self.head, kml_folder_start % state]
+        self.recorded_states[state] = self.recorded_states[state] + 1
+        self.pending[state].append(kml_placemark % (item.get('airport').replace('&',' and '),item.get('link'),'Link',item.get('lon'),item.get('lat')))
+        if len(self.pending[state]) >= self.batch_size:
+            self._flush(state)
+
+    def _flush(self, state):
+        if not self.pending[state]:
+            return
+        state_file = self.open_files.pop(state, None)
+        if state_file is None:
+            #Files pushed out of the open set are reopened to append the next batch
+            state_file = open(self.state_path(state), 'ab' if state in self.started else 'wb')
+            self.started.add(state)
+            if len(self.open_files) >= self.max_open_files:
+                self.open_files.popitem(last=False)[1].close()
+        self.open_files[state] = state_file
+        state_file.write(''.join(self.pending[state]))
+        self.pending[state] = []
+
+    def close(self):
+        """Finish every file and return {state: placemark count}"""
+        for state in self.recorded_states:
+            self.pending[state].append(kml_folder_end + kml_tail)
+            self._flush(state)
+        for state_file in self.open_files.values():
+            state_file.close()
+        self.open_files.clear()
+
+        #The combined file is every state file without its own head and tail
+        combined_path = './{}.kml'.format(self.base_name)
+        with open(combined_path, 'wb') as kml_output_file:
+            kml_output_file.write(self.head)
+            for state in sorted(self.recorded_states):
+                remaining = os.path.getsize(self.state_path(state)) - len(self.head) - len(kml_tail)
+                with open(self.state_path(state), 'rb') as state_file:
+                    state_file.seek(len(self.head))
+                    while remaining > 0:
+                        block = state_file.read(min(remaining, 1024*1024))
+                        kml_output_file.write(block)
+                        remaining = remaining - len(block)
+            kml_output_file.write(kml_tail)
+
+        if self.kmz:
+            for kml_path in [combined_path] + [self.state_path(state) for state in self.recorded_states]:
+                with zipfile.ZipFile(kml_path[:-len('.kml')] + '.kmz', 'w', zipfile.ZIP_DEFLATED) as kmz_file:
+                    kmz_file.write(kml_path, 'doc.kml')
+                os.remove(kml_path)
+        return self.recorded_states
+
+
+def write_kml_file(items,base_name='abandoned_airports',kmz=False):
+    """Write Google Earth kml file to import into Google Maps
+
+    items can be any iterable of airports, including a generator, and are
+    written as they arrive. kmz=True writes compressed .kmz files instead.
+    """
+    print('Writing kml files...')
+    kml_writer = KmlWriter(base_name, kmz=kmz)
+    for item in items:
+        kml_writer.add(item)
+    recorded_states = kml_writer.close()
     print(recorded_states)
     print('Done writing kml files.')
     
     
+csv_head = 'State,Airport,Lat,Lon,Link\n'
+missing_csv_head = 'Closed,Start Date,Through Date,State,City,Name,lat,lon,link'
+
+
+def get_csv_line(item):
+    """Return an airport's line of abandoned_airports.csv"""
+    return '"{}","{}",{},{},"{}"\n'.format(item.get('state'),item.get('airport'),item.get('lat'),item.get('lon'),item.get('link'))
+
+
+def get_missing_csv_line(item):
+    """Return a missing facility's line of the comparison listing, without a line break"""
+    return '"{}","{}","{}","{}","{}","{} ({})",{},{},"{}"'.format(
+        item.get('closed'),
+        item.get('start'),
+        item.get('thru'),
+        item.get('state'),
+        item.get('city'),
+        item.get('airport'), 
+        item.get('id'), 
+        item.get('lat'), 
+        item.get('lon'), 
+        item.get('link'))
+
+
 def write_csv_file(items):
     """Write the list of airports as csv"""    
     print('Writing csv files...')
     csv_output_file = open('./abandoned_airports.csv','w')
-    csv_head = 'State,Airport,Lat,Lon,Link\n'
     csv_output_file.write(csv_head)
     for item in items:
         #print(type(item),item)
-        csv_output_file.write('"{}","{}",{},{},"{}"\n'.format(item.get('state'),item.get('airport'),item.get('lat'),item.get('lon'),item.get('link')))
+        csv_output_file.write(get_csv_line(item))
     csv_output_file.close()
     print('Done writing csv file.')
     
     
-def read_airport_files():
-    """Parse the downloaded airport files and save details"""
-    print('Reading airport files...')
-    #TODO: Speed this up
+def decode_page(page):
+    """Decode page bytes the way BeautifulSoup guesses: declared charset, then utf-8, then windows-1252"""
+    declared = charset_re.search(page)
+    for encoding in ([declared.group(1)] if declared else []) + ['utf-8', 'windows-1252']:
+        try:
+            return page.decode(encoding), encoding
+        except (UnicodeDecodeError, LookupError):
+            continue
+    return page.decode('utf-8', 'replace'), 'utf-8'
+
+
+def replace_entity(match, encoding):
+    """Return the text for an html entity the way BeautifulSoup's html.parser builder does"""
+    name = match.group(1)
+    if name[0] != '#':
+        character = html_entities.get(name)
+        if character is None:
+            return u'&' + name
+        return character
+    code = int(name[2:], 16) if name[1] in 'xX' else int(name[1:])
+    if code < 256:
+        #Numeric entities below 256 are often really windows-1252, same as BeautifulSoup assumes
+        for entity_encoding in (encoding, 'windows-1252'):
+            try:
+                return bytearray([code]).decode(entity_encoding)
+            except UnicodeDecodeError:
+                pass
+    try:
+        return unichr(code)
+    except (ValueError, OverflowError):
+        return u'\N{REPLACEMENT CHARACTER}'
+
+
+def extract_page_text(html):
+    """Return the text of an html page without building a BeautifulSoup tree
+
+    One pass over the page drops comments, declarations, tags and script
+    and style blocks, keeps CDATA verbatim and decodes entities in the text
+    in between, which gives the same text as BeautifulSoup(html).get_text()
+    for the airfield pages.
+    """
+    text, encoding = decode_page(html)
+    unescape = lambda chunk: entity_re.sub(lambda match: replace_entity(match, encoding), chunk)
+    pieces = []
+    position = 0
+    for markup in markup_re.finditer(text):
+        pieces.append(unescape(text[position:markup.start()]))
+        if markup.group(1):
+            pieces.append(markup.group(1))
+        position = markup.end()
+    pieces.append(unescape(text[position:]))
+    return u''.join(pieces)
+
+
+def find_airports(text):
+    """Return the same (airport, lat, lon, direction) tuples as airport_re.findall(text)
+
+    Matches can only start at a run of underscores followed by whitespace,
+    so the record pattern is only tried, anchored, at those runs instead of
+    at every character of the page.
+    """
+    airports = []
+    position = 0
+    for run in underscore_run_re.finditer(text):
+        if run.start() < position:
+            continue
+        match = airport_tail_re.match(text, run.end())
+        if match:
+            airports.append(match.groups())
+            position = match.end()
+    return airports
+
+
+def parse_airport_file(thisFilename, parser='soup'):
+    """Parse one downloaded airport file and return its airport details
+
+    parser='soup' reads the page with BeautifulSoup, parser='fast' uses
+    extract_page_text and find_airports instead, and parser='parity' runs
+    both, reports any difference and returns the BeautifulSoup results.
+    """
     airport_list = []
+    with open(thisFilename,'r') as thisFile:
+        trimmed_html = re.sub(r'\s+',' ',thisFile.read().replace('\n',' '))
+    if parser == 'fast':
+        airports = find_airports(repr(extract_page_text(trimmed_html)))
+    elif parser in ('soup', 'parity'):
+        soup = BeautifulSoup(trimmed_html, 'html.parser')
+
+        trimmed_text = soup.get_text()
+        airports = airport_re.findall(repr(trimmed_text))
+        if parser == 'parity':
+            fast_airports = find_airports(repr(extract_page_text(trimmed_html)))
+            if fast_airports != airports:
+                differences = [(soup_airport, fast_airport) for soup_airport, fast_airport in itertools.izip_longest(airports, fast_airports) if soup_airport != fast_airport]
+                print('Parity check failed for {}: {} soup airports, {} fast airports, first difference {} != {}'.format(
+                    thisFilename, len(airports), len(fast_airports), differences[0][0], differences[0][1]))
+    else:
+        raise ValueError('Unknown parser: {}'.format(parser))
+    state = re.findall(r'Airfields_([A-Z]+)_?',thisFilename)
+    state = state[0]
+    link = '{}{}/{}'.format(base_url,state,thisFilename)
+
+    for airport,lat,lon,lon_direction in airports:
+        #TODO: check longitude direction East vs. West, this if statement is hacky
+        if float(lon) > 0 and float(lon) < 135:
+            """Longitude should be in the Western Hemisphere"""
+            lon = '-%s'%lon
+        airport_list.append({'airport':airport, 'lat':lat, 'lon':lon, 'state':state, 'link':link})
+    return airport_list
+
+
+def parse_airport_file_safely(thisFilename, parser='soup'):
+    """Parse one airport file, returning (filename, airports, error) instead of raising"""
+    try:
+        return thisFilename, parse_airport_file(thisFilename, parser), None
+    except Exception as e:
+        return thisFilename, [], '{}: {}'.format(type(e).__name__, e)
+
+
+def get_file_hash(filename):
+    """Return the sha1 hex digest of a file's contents"""
+    file_hash = hashlib.sha1()
+    with open(filename, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(1024*1024), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def load_parse_cache(path=parse_cache_file):
+    """Load cached airport details, keyed by filename, dropping entries from other parser versions"""
+    if not os.path.isfile(path):
+        return dict()
+    try:
+        with open(path, 'r') as cache_file:
+            cache = json.load(cache_file)
+    except ValueError:
+        print('Parse cache {} is unreadable, ignoring it.'.format(path))
+        return dict()
+    return dict((str(thisFilename), entry) for thisFilename, entry in cache.items() if entry.get('parser_version') == parser_version)
 
+
+def iter_airport_files(workers=1, cache_path=parse_cache_file, parser='soup'):
+    """Parse the downloaded airport files, yielding airports as each file is read
+
+    workers > 1 spreads the files over a process pool (None uses every
+    core). Airports come out in filename order however the work was split,
+    and a file that fails to parse is reported and skipped.
+
+    Parsed details are cached in cache_path keyed by each file's content
+    hash and the parser version, so only new or changed files are parsed.
+    The cache is written once every file has been read. Pass cache_path=None
+    to parse everything without a cache, which also avoids holding every
+    airport in memory for it.
+
+    parser is passed on to parse_airport_file. Cached results are only used
+    for the parser that produced them, and parser='parity' always re-parses.
+    """
     #get list of files
     #Loop through all .htm files
     #check for airport name, lat/lon, link
-    for thisFilename in os.listdir("./"):
-        if thisFilename.endswith(".htm"):
-            #print(thisFilename)
-            thisFile = open(thisFilename,'r+')
-            #print('Parsing {}...'.format(thisFilename))
-            trimmed_html = re.sub(r'\s+',' ',thisFile.read().replace('\n',' '))
-            soup = BeautifulSoup(trimmed_html, 'html.parser')
-            
-            trimmed_text = soup.get_text()
-            airports = re.findall(r'_+_\s+([^_]{0,200}[)A-Z])\s+(-?\d+[.]?\d+)\s*[NnOoRrTtHh]*\s*[,/]\s*(-?\d+[.]?\d+)\s+(\S+)',repr(trimmed_text))
-            state = re.findall(r'Airfields_([A-Z]+)_?',thisFilename)
-            state = state[0]
-            link = '{}{}/{}'.format(base_url,state,thisFilename)
-                
-            for airport,lat,lon,lon_direction in airports:
-                #TODO: check longitude direction East vs. West, this if statement is hacky
-                if float(lon) > 0 and float(lon) < 135:
-                    """Longitude should be in the Western Hemisphere"""
-                    lon = '-%s'%lon
-                airport_list.append({'airport':airport, 'lat':lat, 'lon':lon, 'state':state, 'link':link})
-            pass
+    filenames = sorted([thisFilename for thisFilename in os.listdir("./") if thisFilename.endswith(".htm")])
+    cache = load_parse_cache(cache_path) if cache_path else dict()
+    new_cache = dict()
+    stale = []
+    for thisFilename in filenames:
+        #Without a cache there is nothing to match the hash against
+        file_hash = get_file_hash(thisFilename) if cache_path else None
+        entry = cache.get(thisFilename)
+        if entry and entry.get('hash') == file_hash and entry.get('parser', 'soup') == parser:
+            new_cache[thisFilename] = entry
+        else:
+            new_cache[thisFilename] = {'hash':file_hash, 'parser_version':parser_version, 'parser':'fast' if parser == 'fast' else 'soup'}
+            stale.append(thisFilename)
+    print('{} files unchanged, {} to parse.'.format(len(filenames) - len(stale), len(stale)))
+
+    pool = None
+    if workers != 1 and len(stale) > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(functools.partial(parse_airport_file_safely, parser=parser), stale, chunksize=4)
+    else:
+        results = itertools.imap(functools.partial(parse_airport_file_safely, parser=parser), stale)
+    try:
+        for thisFilename in filenames:
+            if 'airports' in new_cache[thisFilename]:
+                for airport in new_cache[thisFilename]['airports']:
+                    yield dict((str(key), str(value)) for key, value in airport.items())
+                continue
+            #Stale files come back from results in the same order
+            thisFilename, airports, error = next(results)
+            if error:
+                print('Error parsing {}, skipping. {}'.format(thisFilename, error))
+                del new_cache[thisFilename]
+                continue
+            if cache_path:
+                new_cache[thisFilename]['airports'] = airports
+            for airport in airports:
+                yield airport
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    #Entries for pages that are no longer on disk are left out of new_cache
+    if cache_path and (stale or set(cache) != set(new_cache)):
+        write_json_file(new_cache, cache_path)
+
+
+def read_airport_files(workers=1, cache_path=parse_cache_file, parser='soup'):
+    """Parse the downloaded airport files and return a list of their airports, see iter_airport_files"""
+    print('Reading airport files...')
+    airport_list = list(iter_airport_files(workers, cache_path, parser))
     print('Done reading airport files.')
     return airport_list
 
 
-def compare_locations(airports,test_airports,filter_dist=5):
-    """Check Abandoned Airfields locations against BTS and NFDC airport locations"""
+def get_closest_distances(airports,test_airports,filter_dist=5,method='index'):
+    """Return the distance from each test airport to its closest airport
+
+    method='index' queries an AirportIndex per test airport and reports
+    anything farther than filter_dist as inf, method='batch' finds every
+    nearest distance at once with haversine_nearest.
+    """
     airport_lat,airport_lon = get_lat_lon_from_list(airports)
+    test_lat,test_lon = get_lat_lon_from_list(test_airports)
+    if method == 'batch':
+        closest_distances, _ = haversine_nearest(test_lat, test_lon, airport_lat, airport_lon)
+    elif method == 'index':
+        airport_index = AirportIndex(airport_lat, airport_lon)
+        closest_distances = [airport_index.nearest(lat1, lon1, max_dist=filter_dist)[0] for lat1, lon1 in zip(test_lat, test_lon)]
+    else:
+        raise ValueError('Unknown comparison method: {}'.format(method))
+    return np.asarray(closest_distances)
+
+
+def get_airport_grid(lat, lon, radius, grid_path=None):
+    """Return an AirportGrid of the airports, reusing the one in grid_path if it was built from the same airports and radius"""
+    if not grid_path:
+        return AirportGrid(lat, lon, radius)
+    grid_tag = {'version':snapshot_version, 'radius':float(radius), 'airports':len(lat),
+                'sha1':hashlib.sha1(np.ascontiguousarray(lat).tobytes() + np.ascontiguousarray(lon).tobytes()).hexdigest()}
+    if os.path.isfile(grid_path):
+        try:
+            grid, saved_tag = AirportGrid.load(grid_path)
+            if saved_tag == grid_tag:
+                return grid
+        except (IOError, ValueError, KeyError) as e:
+            print('Grid {} is unreadable, rebuilding it. {}'.format(grid_path, e))
+    grid = AirportGrid(lat, lon, radius)
+    grid.save(grid_path, grid_tag)
+    return grid
+
+
+def find_missing(airports,test_airports,filter_dist=5,method='grid',grid_path=None):
+    """Return a boolean array, True for each test airport with no airport within filter_dist km
+
+    method='grid' answers the yes/no question from an AirportGrid, kept in
+    grid_path between runs when given, and falls back to 'index' when
+    filter_dist is too small to key a grid on. 'index' and 'batch' work out
+    each closest distance with get_closest_distances.
+    """
+    if method == 'grid':
+        airport_lat,airport_lon = get_lat_lon_from_list(airports)
+        try:
+            grid = get_airport_grid(airport_lat, airport_lon, filter_dist, grid_path)
+        except ValueError:
+            method = 'index'
+        else:
+            test_lat,test_lon = get_lat_lon_from_list(test_airports)
+            return ~grid.contains_within(test_lat, test_lon)
+    return get_closest_distances(airports, test_airports, filter_dist, method) > filter_dist
+
+
+def compare_locations(airports,test_airports,filter_dist=5,method='grid',baseline_path=None,report_path=None):
+    """Check Abandoned Airfields locations against BTS and NFDC airport locations
+
+    See find_missing for method. With baseline_path the compared
+    tables and result are kept in baseline_path.reference.npz and
+    baseline_path.tested.npz, and the next run only re-evaluates facilities
+    affected by changes since then, writing what changed to report_path.
+    The grid of the reference airports is kept in baseline_path.grid.npz,
+    so it is only built again when they change.
+    """
+    missing = None
+    grid_path = baseline_path + '.grid.npz' if baseline_path else None
+    if baseline_path:
+        baseline = load_comparison_baseline(baseline_path, filter_dist)
+        if baseline is not None:
+            missing, changes = compare_locations_incremental(baseline[0], airports, baseline[1], test_airports, baseline[2], filter_dist, grid_path)
+            if report_path:
+                write_changes_csv(changes, report_path)
+    if missing is None:
+        missing = find_missing(airports, test_airports, filter_dist, method, grid_path)
+    if baseline_path:
+        save_comparison_baseline(baseline_path, airports, test_airports, missing, filter_dist)
     missing_items = []
-    print('Closed,Start Date,Through Date,State,City,Name,lat,lon,link')
-    for test_airport in test_airports:
-        lon1 = test_airport.get('lon')
-        lat1 = test_airport.get('lat')
-        distances = haversine_np(lon1, lat1, airport_lon, airport_lat)
-        closest = min(distances)
-        if closest > filter_dist:# and test_airport.get('closed') == '1':
-            missing_items.append({'airport':test_airport.get('airport'), 
-                                  'lat':test_airport.get('lat'), 
-                                  'lon':test_airport.get('lon'), 
-                                  'state':test_airport.get('state'),
-                                  'city':test_airport.get('city'),
-                                  'closed':test_airport.get('closed'),
-                                  'start':test_airport.get('start'),
-                                  'id':test_airport.get('id'),
-                                  'link':test_airport.get('link')})
-
-            print('"{}","{}","{}","{}","{}","{} ({})",{},{},"{}"'.format(
-                test_airport.get('closed'),
-                test_airport.get('start'),
-                test_airport.get('thru'),
-                test_airport.get('state'),
-                test_airport.get('city'),
-                test_airport.get('airport'), 
-                test_airport.get('id'), 
-                test_airport.get('lat'), 
-                test_airport.get('lon'), 
-                test_airport.get('link')))
-    #TODO: sort by state before writing to kml
+    print(missing_csv_head)
+    for position in np.nonzero(missing)[0]:# and test_airport.get('closed') == '1':
+        test_airport = test_airports[position]
+        missing_items.append({'airport':test_airport.get('airport'), 
+                              'lat':test_airport.get('lat'), 
+                              'lon':test_airport.get('lon'), 
+                              'state':test_airport.get('state'),
+                              'city':test_airport.get('city'),
+                              'closed':test_airport.get('closed'),
+                              'start':test_airport.get('start'),
+                              'id':test_airport.get('id'),
+                              'link':test_airport.get('link')})
+
+        print(get_missing_csv_line(test_airport))
     write_kml_file(missing_items,base_name='missing_items')
     return missing_items
 
-def get_bts_airport_list():
-    """Read BTS Master Coordinates list and return airport details
-    Source: https://www.transtats.bts.gov/DL_SelectFields.asp?Table_ID=288&DB_Short_Name=Aviation%20Support%20Tables"""
+
+def get_facility_keys(airports):
+    """Return a key per facility: its airport_id, else its id, else its rounded coordinates
+
+    BTS reuses and reassigns its three letter codes (id), so its permanent
+    AIRPORT_ID is preferred where a source has one.
+    """
+    lat, lon = get_lat_lon_from_list(airports)
+    ids = None
+    for column in ['airport_id', 'id']:
+        if isinstance(airports, AirportTable):
+            column_ids = airports.get_column(column) if column in airports.columns else [None]*len(airports)
+        else:
+            column_ids = [airport.get(column) for airport in airports]
+        ids = column_ids if ids is None else [airport_id or fallback for airport_id, fallback in zip(ids, column_ids)]
+    return [airport_id if airport_id else (round(lat1, 4), round(lon1, 4)) for airport_id, lat1, lon1 in zip(ids, lat, lon)]
+
+
+def diff_airport_tables(old_airports, airports):
+    """Match facilities between two versions of a source by id and coordinates
+
+    Returns a dict of position arrays: 'added' into airports, 'removed' into
+    old_airports, and 'moved' and 'unchanged' as (old positions, positions)
+    pairs, where moved facilities have any change to their coordinates, as
+    even a small shift can carry one across filter_dist. Facilities sharing
+    an id are paired at the same coordinates first, then in the order they
+    appear.
+    """
+    old_lat, old_lon = get_lat_lon_from_list(old_airports)
+    lat, lon = get_lat_lon_from_list(airports)
+    old_keys = get_facility_keys(old_airports)
+    keys = get_facility_keys(airports)
+    matched_old, matched = [], []
+    unmatched_old = range(len(old_keys))
+    unmatched = range(len(keys))
+    for get_key in [lambda keys, lat, lon, position: (keys[position], round(lat[position], 4), round(lon[position], 4)),
+                    lambda keys, lat, lon, position: keys[position]]:
+        waiting = collections.defaultdict(collections.deque)
+        for position in unmatched_old:
+            waiting[get_key(old_keys, old_lat, old_lon, position)].append(position)
+        still_unmatched = []
+        for position in unmatched:
+            key = get_key(keys, lat, lon, position)
+            if waiting.get(key):
+                matched_old.append(waiting[key].popleft())
+                matched.append(position)
+            else:
+                still_unmatched.append(position)
+        unmatched_old = sorted(position for positions in waiting.values() for position in positions)
+        unmatched = still_unmatched
+    matched_old = np.array(matched_old, dtype=np.int64)
+    matched = np.array(matched, dtype=np.int64)
+    moved = (old_lat[matched_old] != lat[matched]) | (old_lon[matched_old] != lon[matched])
+    return {'added':np.array(unmatched, dtype=np.int64),
+            'removed':np.array(unmatched_old, dtype=np.int64),
+            'moved':(matched_old[moved], matched[moved]),
+            'unchanged':(matched_old[~moved], matched[~moved])}
+
+
+def compare_locations_incremental(old_airports, airports, old_test_airports, test_airports, old_missing, filter_dist=5, grid_path=None):
+    """Update the result of comparing old_test_airports to old_airports for the new versions of both
+
+    Only test airports that were added or moved, or that lie within
+    filter_dist of a place an airport was added, removed or moved, are
+    checked again, the rest keep their old result. Returns the missing mask
+    for test_airports and a list of the test airports whose result changed,
+    each with 'change' (missing or resolved) and 'reason'. grid_path is
+    passed on to find_missing.
+    """
+    airport_changes = diff_airport_tables(old_airports, airports)
+    test_changes = diff_airport_tables(old_test_airports, test_airports)
+    old_lat, old_lon = get_lat_lon_from_list(old_airports)
+    lat, lon = get_lat_lon_from_list(airports)
+    test_lat, test_lon = get_lat_lon_from_list(test_airports)
+    old_kept, kept = test_changes['unchanged']
+    old_moved, moved = test_changes['moved']
+    was_missing = np.zeros(len(test_airports), dtype=bool)
+    was_missing[kept] = old_missing[old_kept]
+    was_missing[moved] = old_missing[old_moved]
+    missing = was_missing.copy()
+    reasons = dict((position, 'added') for position in test_changes['added'])
+    reasons.update((position, 'moved') for position in moved)
+
+    #Places where an airport disappeared or appeared
+    changed_old = np.concatenate([airport_changes['removed'], airport_changes['moved'][0]])
+    changed = np.concatenate([airport_changes['added'], airport_changes['moved'][1]])
+    changed_lat = np.concatenate([old_lat[changed_old], lat[changed]])
+    changed_lon = np.concatenate([old_lon[changed_old], lon[changed]])
+    if len(changed_lat) and len(kept):
+        kept_index = AirportIndex(test_lat[kept], test_lon[kept])
+        for lat1, lon1 in zip(changed_lat, changed_lon):
+            for position in kept[kept_index.within(lat1, lon1, filter_dist)]:
+                reasons.setdefault(position, 'nearby change')
+
+    affected = np.array(sorted(reasons), dtype=np.int64)
+    if len(affected):
+        missing[affected] = find_missing(airports, test_airports[affected] if isinstance(test_airports, AirportTable) else [test_airports[position] for position in affected], filter_dist, grid_path=grid_path)
+    print('Re-evaluated {} of {} facilities after {} airport and {} facility changes.'.format(
+        len(affected), len(test_airports), len(changed_old) + len(airport_changes['added']),
+        len(test_changes['added']) + len(test_changes['removed']) + len(moved)))
+
+    changes = []
+    for position in affected:
+        if missing[position] != was_missing[position]:
+            changes.append(dict(test_airports[position], change='missing' if missing[position] else 'resolved', reason=reasons[position]))
+    for position in test_changes['removed']:
+        if old_missing[position]:
+            changes.append(dict(old_test_airports[position], change='resolved', reason='removed'))
+    return missing, changes
+
+
+def load_comparison_baseline(baseline_path, filter_dist):
+    """Return (airports, test airports, missing mask) saved by an earlier comparison, or None"""
+    try:
+        airports, reference_tag = AirportTable.load(baseline_path + '.reference.npz')
+        test_airports, tested_tag = AirportTable.load(baseline_path + '.tested.npz')
+    except (IOError, ValueError, KeyError):
+        return None
+    if tested_tag.get('version') != snapshot_version or tested_tag.get('filter_dist') != filter_dist:
+        return None
+    missing = np.zeros(len(test_airports), dtype=bool)
+    missing[np.array(tested_tag.get('missing'), dtype=np.int64)] = True
+    return airports, test_airports, missing
+
+
+def save_comparison_baseline(baseline_path, airports, test_airports, missing, filter_dist):
+    """Keep both compared tables and which test airports were missing for the next comparison"""
+    if not isinstance(airports, AirportTable):
+        airports = AirportTable.from_records(airports)
+    if not isinstance(test_airports, AirportTable):
+        test_airports = AirportTable.from_records(test_airports)
+    airports.save(baseline_path + '.reference.npz', {'version':snapshot_version})
+    test_airports.save(baseline_path + '.tested.npz', {'version':snapshot_version, 'filter_dist':filter_dist,
+                                                       'missing':np.nonzero(missing)[0].tolist()})
+
+
+def write_changes_csv(changes, path):
+    """Write one line per facility whose comparison result changed"""
+    print('Writing {} changes to {}...'.format(len(changes), path))
+    csv_output_file = open(path,'w')
+    csv_output_file.write('Change,Reason,Closed,Start Date,Through Date,State,City,Name,Id,Lat,Lon,Link\n')
+    for item in changes:
+        csv_output_file.write('"{}","{}","{}","{}","{}","{}","{}","{}","{}",{},{},"{}"\n'.format(item.get('change'),item.get('reason'),item.get('closed'),item.get('start'),item.get('thru'),
+                                                                                     item.get('state'),item.get('city'),item.get('airport'),item.get('id'),item.get('lat'),item.get('lon'),item.get('link')))
+    csv_output_file.close()
+    print('Done writing changes csv file.')
+
+def is_open_facility(source, airport):
+    """Guess whether a facility still operates: NFDC lists only current facilities, BTS flags closed ones
+
+    Facilities of the candidate source are the ones in question, so they
+    never count as open.
+    """
+    if source == 'candidate':
+        return False
+    if source == 'nfdc':
+        return True
+    return airport.get('closed') == '0'
+
+
+def cluster_airports(sources, radius=2):
+    """Group facilities from several sources that lie within radius km of each other
+
+    sources is a list of (name, airports) pairs, earlier sources win when
+    attributes are merged. Facilities are joined with a union-find over the
+    pairs from find_close_pairs, so chains of nearby facilities end up in one
+    cluster. Returns one dict per cluster with the merged airport details,
+    a centroid, the member (source, position) pairs, the sources involved,
+    whether any member is an open facility and whether any member comes from
+    the source named 'candidate'. A candidate's own record in the source it
+    was taken from, the same id at the same coordinates, is folded into the
+    candidate rather than kept as another member.
+    """
+    names, positions, lats, lons = [], [], [], []
+    for name, airports in sources:
+        airport_lat, airport_lon = get_lat_lon_from_list(airports)
+        names.extend([name]*len(airport_lat))
+        positions.extend(range(len(airport_lat)))
+        lats.append(airport_lat)
+        lons.append(airport_lon)
+    lat = np.concatenate(lats) if lats else np.zeros(0)
+    lon = np.concatenate(lons) if lons else np.zeros(0)
+    first, second = find_close_pairs(lat, lon, radius)
+
+    parents = range(len(lat))
+    def find(item):
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+    for item1, item2 in itertools.izip(first.tolist(), second.tolist()):
+        root1, root2 = find(item1), find(item2)
+        if root1 != root2:
+            parents[max(root1, root2)] = min(root1, root2)
+
+    members = collections.OrderedDict()
+    for item in range(len(lat)):
+        members.setdefault(find(item), []).append(item)
+    airports_by_source = dict(sources)
+    clusters = []
+    for items in members.values():
+        candidates = set((airports_by_source[names[item]][positions[item]].get('id'), lat[item], lon[item]) for item in items if names[item] == 'candidate')
+        if candidates:
+            items = [item for item in items if names[item] == 'candidate' or
+                     (airports_by_source[names[item]][positions[item]].get('id'), lat[item], lon[item]) not in candidates]
+        cluster = {'members':[(names[item], positions[item]) for item in items],
+                   'sources':sorted(set([names[item] for item in items])),
+                   'lat':float(np.mean(lat[items])),
+                   'lon':float(np.mean(lon[items])),
+                   'ids':[],
+                   'open':False,
+                   'candidate':bool(candidates)}
+        for item in items:
+            airport = airports_by_source[names[item]][positions[item]]
+            for key in ('airport', 'state', 'city', 'start', 'thru', 'closed', 'link'):
+                if not cluster.get(key) and airport.get(key):
+                    cluster[key] = airport.get(key)
+            if airport.get('id') and airport.get('id') not in cluster['ids']:
+                cluster['ids'].append(airport.get('id'))
+            cluster['open'] = cluster['open'] or is_open_facility(names[item], airport)
+        clusters.append(cluster)
+    return clusters
+
+
+def write_clusters_csv(clusters, path='./airport_clusters.csv'):
+    """Write one line per cluster of facilities, with whether it includes an open facility"""
+    print('Writing cluster csv file...')
+    csv_output_file = open(path,'w')
+    csv_output_file.write('State,Airport,Lat,Lon,Open,Sources,Members,Ids,Link\n')
+    for cluster in clusters:
+        csv_output_file.write('"{}","{}",{},{},{},"{}",{},"{}","{}"\n'.format(cluster.get('state'),cluster.get('airport'),cluster.get('lat'),cluster.get('lon'),
+                                                                          int(cluster.get('open')),' '.join(cluster.get('sources')),len(cluster.get('members')),' '.join(cluster.get('ids')),cluster.get('link')))
+    csv_output_file.close()
+    print('Done writing cluster csv file.')
+
+
+#A registered source: loader returning an AirportTable, glob patterns of the files it reads, and
+#whether it can run in a worker process of load_sources or spreads its own work over processes
+AirportSource = collections.namedtuple('AirportSource', ['loader', 'files', 'in_pool'])
+airport_sources = collections.OrderedDict()
+
+
+def register_source(name, files, in_pool=True):
+    """Decorator registering a loader as a named airport source, see load_sources"""
+    def register(loader):
+        airport_sources[name] = AirportSource(loader, files, in_pool)
+        return loader
+    return register
+
+
+def get_source_tag(path, known_tag=None):
+    """Describe a source file by size, modified time and content hash
+
+    The hash is taken from known_tag instead of re-reading the file when its
+    size and modified time are unchanged.
+    """
+    stat = os.stat(path)
+    source_tag = {'size':stat.st_size, 'mtime':stat.st_mtime, 'version':snapshot_version}
+    if known_tag and known_tag.get('size') == stat.st_size and known_tag.get('mtime') == stat.st_mtime:
+        source_tag['sha1'] = known_tag.get('sha1')
+    else:
+        source_tag['sha1'] = get_file_hash(path)
+    return source_tag
+
+
+def load_snapshot(snapshot_path, source_path):
+    """Return the AirportTable snapshot of source_path, or None if it is missing or out of date"""
+    if not snapshot_path or not os.path.isfile(snapshot_path):
+        return None
+    try:
+        table, snapshot_tag = AirportTable.load(snapshot_path)
+    except (IOError, ValueError, KeyError) as e:
+        print('Snapshot {} is unreadable, ignoring it. {}'.format(snapshot_path, e))
+        return None
+    if snapshot_tag.get('version') != snapshot_version:
+        return None
+    source_tag = get_source_tag(source_path, snapshot_tag)
+    if source_tag['sha1'] != snapshot_tag.get('sha1') or source_tag['size'] != snapshot_tag.get('size'):
+        return None
+    if source_tag != snapshot_tag:
+        #Same contents with a new modified time, re-tag so the next run can skip hashing
+        table.save(snapshot_path, source_tag)
+    print('Loaded {} airports from snapshot {}.'.format(len(table), snapshot_path))
+    return table
+
+
+def save_snapshot(table, snapshot_path, source_path):
+    """Save an AirportTable snapshot tagged with the current state of source_path"""
+    if snapshot_path:
+        table.save(snapshot_path, get_source_tag(source_path))
+
+
+@register_source('bts', ['737306034_T_MASTER_CORD.csv'])
+def get_bts_airport_list(path='737306034_T_MASTER_CORD.csv', snapshot_path='bts_snapshot.npz'):
+    """Read BTS Master Coordinates list and return airport details as an AirportTable
+    Source: https://www.transtats.bts.gov/DL_SelectFields.asp?Table_ID=288&DB_Short_Name=Aviation%20Support%20Tables
+
+    The parsed table is kept in snapshot_path and reused until the csv
+    changes. Pass snapshot_path=None to always re-read the csv."""
     #TODO: Download an updated file from https://www.transtats.bts.gov/DL_SelectFields.asp?Table_ID=288&DB_Short_Name=Aviation%20Support%20Tables
     #TODO: Allow closed or open runways to be returned
-    airport_list = []
-    with open('737306034_T_MASTER_CORD.csv', 'rb') as csvfile:
+    airport_table = load_snapshot(snapshot_path, path)
+    if airport_table is not None:
+        return airport_table
+    airport_table = AirportTable.from_records(iter_bts_airports(path))
+    save_snapshot(airport_table, snapshot_path, path)
+    return airport_table
+
+
+def iter_bts_airports(path='737306034_T_MASTER_CORD.csv', columns=bts_columns):
+    """Yield the current US airports of the BTS Master Coordinates list one row at a time"""
+    with open(path, 'rb') as csvfile:
         bts_airports = csv.reader(csvfile, delimiter=',', quotechar='"')
-        #Col 27: AIRPORT_IS_LATEST
-        #Col  7: AIRPORT_COUNTRY_CODE_ISO
-        #Col 18: lat
-        for row in [row for row in bts_airports if row[7] == 'US' and '.' in row[18] and row[27] == '1']:
+        for row in bts_airports:
+            lat, lon = row[columns['lat']], row[columns['lon']]
+            if not (row[columns['country']] == 'US' and '.' in lat and row[columns['latest']] == '1'):
+                continue
             #print ', '.join(row)
-            airport_list.append({'airport':row[3], 
-                                 'lat':float(row[18]), 
-                                 'lon':float(row[23]), 
-                                 'link':'https://skyvector.com/?ll=%s,%s&chart=301&zoom=1'%(row[18],row[23]),
-                                 'state':row[9], 
-                                 'city':row[4],
-                                 'start':row[24],
-                                 'thru':row[25], 
-                                 'closed':row[26], 
-                                 'id':row[2]})
-    return airport_list
+            yield {'airport':row[columns['airport']], 
+                   'lat':float(lat), 
+                   'lon':float(lon), 
+                   'link':'https://skyvector.com/?ll=%s,%s&chart=301&zoom=1'%(lat,lon),
+                   'state':row[columns['state']], 
+                   'city':row[columns['city']],
+                   'start':row[columns['start']],
+                   'thru':row[columns['thru']], 
+                   'closed':row[columns['closed']], 
+                   'id':row[columns['id']],
+                   'airport_id':row[columns['airport_id']]}
 
 
-def get_nfdc_airport_list():
-    """Read NFDC airport list and return: Country, State, Airport name, Lat, Lon, Operational"""
-    airport_list = []
-    nfdc_file = open('nfdc.csv','w')
-    nfdc_header = '"' + '","'.join(["RECORD TYPE INDICATOR".replace("'",''),"LANDING FACILITY SITE NUMBER".replace("'",''),"LANDING FACILITY TYPE".replace("'",''),"LOCATION IDENTIFIER".replace("'",''),"INFORMATION EFFECTIVE DATE (MM/DD/YYYY)".replace("'",''),"FAA REGION CODE".replace("'",''),"FAA DISTRICT OR FIELD OFFICE CODE".replace("'",''),"ASSOCIATED STATE POST OFFICE CODE".replace("'",''),"ASSOCIATED STATE NAME".replace("'",''),"ASSOCIATED COUNTY (OR PARISH) NAME".replace("'",''),"ASSOCIATED COUNTY'S STATE (POST OFFICE CODE)".replace("'",''),"ASSOCIATED CITY NAME".replace("'",''),"OFFICIAL FACILITY NAME".replace("'",''),"AIRPORT OWNERSHIP TYPE".replace("'",''),"FACILITY USE".replace("'",''),"FACILITY OWNER'S NAME".replace("'",''),"OWNER'S ADDRESS".replace("'",''),"OWNER'S CITY, STATE AND ZIP CODE".replace("'",''),"FACILITY MANAGER'S NAME".replace("'",''),"MANAGER'S ADDRESS".replace("'",''),"MANAGER'S CITY, STATE AND ZIP CODE".replace("'",''),"AIRPORT REFERENCE POINT LATITUDE (FORMATTED)".replace("'",''),"AIRPORT REFERENCE POINT LATITUDE (SECONDS)".replace("'",''),"AIRPORT REFERENCE POINT LONGITUDE (FORMATTED)".replace("'",''),"AIRPORT REFERENCE POINT LONGITUDE (SECONDS)".replace("'",''),"AIRPORT REFERENCE POINT DETERMINATION METHOD".replace("'",''),"AIRPORT ELEVATION DETERMINATION METHOD".replace("'",''),"MAGNETIC VARIATION AND DIRECTION".replace("'",''),"MAGNETIC VARIATION EPOCH YEAR".replace("'",''),"AERONAUTICAL SECTIONAL CHART ON WHICH FACILITY".replace("'",''),"DISTANCE FROM CENTRAL BUSINESS DISTRICT OF".replace("'",''),"DIRECTION OF AIRPORT FROM CENTRAL BUSINESS".replace("'",''),"BOUNDARY ARTCC IDENTIFIER".replace("'",''),"BOUNDARY ARTCC (FAA) COMPUTER IDENTIFIER".replace("'",''),"BOUNDARY ARTCC NAME".replace("'",''),"RESPONSIBLE ARTCC IDENTIFIER".replace("'",''),"RESPONSIBLE ARTCC (FAA) COMPUTER IDENTIFIER".replace("'",''),"RESPONSIBLE ARTCC NAME".replace("'",''),"TIE-IN FSS PHYSICALLY LOCATED ON FACILITY".replace("'",''),"TIE-IN FLIGHT SERVICE STATION (FSS) IDENTIFIER".replace("'",''),"TIE-IN FSS NAME".replace("'",''),"LOCAL PHONE NUMBER FROM AIRPORT TO FSS".replace("'",''),"TOLL FREE PHONE NUMBER FROM AIRPORT TO FSS".replace("'",''),"ALTERNATE FSS IDENTIFIER".replace("'",''),"ALTERNATE FSS NAME".replace("'",''),"TOLL FREE PHONE NUMBER FROM AIRPORT TO".replace("'",''),"IDENTIFIER OF THE FACILITY RESPONSIBLE FOR".replace("'",''),"AVAILABILITY OF NOTAM 'D' SERVICE AT AIRPORT".replace("'",''),"AIRPORT ACTIVATION DATE (MM/YYYY)".replace("'",''),"AIRPORT STATUS CODE".replace("'",''),"AIRPORT ARFF CERTIFICATION TYPE AND DATE".replace("'",''),"NPIAS/FEDERAL AGREEMENTS CODE".replace("'",''),"AIRPORT AIRSPACE ANALYSIS DETERMINATION".replace("'",''),"FACILITY HAS BEEN DESIGNATED BY THE U.S. TREASURY".replace("'",''),"FACILITY HAS BEEN DESIGNATED BY THE U.S. TREASURY".replace("'",''),"FACILITY HAS MILITARY/CIVIL JOINT USE AGREEMENT".replace("'",''),"AIRPORT HAS ENTERED INTO AN AGREEMENT THAT".replace("'",''),"AIRPORT INSPECTION METHOD".replace("'",''),"AGENCY/GROUP PERFORMING PHYSICAL INSPECTION".replace("'",''),"LAST PHYSICAL INSPECTION DATE (MMDDYYYY)".replace("'",''),"LAST DATE INFORMATION REQUEST WAS COMPLETED".replace("'",''),"FUEL TYPES AVAILABLE FOR PUBLIC USE AT THE".replace("'",''),"AIRFRAME REPAIR SERVICE AVAILABILITY/TYPE".replace("'",''),"POWER PLANT (ENGINE) REPAIR AVAILABILITY/TYPE".replace("'",''),"TYPE OF BOTTLED OXYGEN AVAILABLE (VALUE REPRESENTS".replace("'",''),"TYPE OF BULK OXYGEN AVAILABLE (VALUE REPRESENTS".replace("'",''),"AIRPORT LIGHTING SCHEDULE".replace("'",''),"BEACON LIGHTING SCHEDULE".replace("'",''),"AIR TRAFFIC CONTROL TOWER LOCATED ON AIRPORT".replace("'",''),"UNICOM FREQUENCY AVAILABLE AT THE AIRPORT".replace("'",''),"COMMON TRAFFIC ADVISORY FREQUENCY (CTAF)".replace("'",''),"SEGMENTED CIRCLE AIRPORT MARKER SYSTEM ON THE AIRPORT".replace("'",''),"LENS COLOR OF OPERABLE BEACON LOCATED ON THE AIRPORT".replace("'",''),"LANDING FEE CHARGED TO NON-COMMERCIAL USERS OF".replace("'",''),"A Y IN THIS FIELD INDICATES THAT THE LANDING".replace("'",''),"12-MONTH ENDING DATE ON WHICH ANNUAL OPERATIONS DATA".replace("'",''),"AIRPORT POSITION SOURCE".replace("'",''),"AIRPORT POSITION SOURCE DATE (MM/DD/YYYY)".replace("'",''),"AIRPORT ELEVATION SOURCE".replace("'",''),"AIRPORT ELEVATION SOURCE DATE (MM/DD/YYYY)".replace("'",''),"CONTRACT FUEL AVAILABLE".replace("'",''),"TRANSIENT STORAGE FACILITIES".replace("'",''),"OTHER AIRPORT SERVICES AVAILABLE".replace("'",''),"WIND INDICATOR".replace("'",''),"ICAO IDENTIFIER".replace("'",''),"AIRPORT RECORD FILLER (BLANK)".replace("'",'')]) + '"'
-    nfdc_file.write(nfdc_header)
-    
-    i = 0
-    with open('APT.txt', 'rb') as aptfile:
-        line = aptfile.readline()
-        while len(line)>0:
-            try:
-                if line[0:3] == 'APT':
-                    i = i + 1
-                    #print(i)
-                    latsec = line[538:550].strip()
-                    lonsec = line[565:577].strip()
-                    NS = 1
-                    if latsec[-1] == 'S':
-                        NS = -1
-                    EW = 1
-                    if lonsec[-1] == 'W':
-                        EW = -1
-                    airport_list.append({'airport':line[133:183].strip(), 
-                                         'lat':NS*float(latsec[0:-1])/3600, 
-                                         'lon':EW*float(lonsec[0:-1])/3600, 
-                                         'link':'nfdc',
-                                         'state':line[48:50].strip(), 
-                                         'city':line[93:133].strip(),
-                                         'start':line[31:41].strip(),
-                                         'id':line[27:31].strip()})
-                    if len(line[48:50].strip()) > 0:
-                        nfdc_line = '\n"' + '","'.join([line[0:3].strip(),line[3:14].strip(),line[14:27].strip(),line[27:31].strip(),line[31:41].strip(),line[41:44].strip(),line[44:48].strip(),line[48:50].strip(),line[50:70].strip(),line[70:91].strip(),line[91:93].strip(),line[93:133].strip(),line[133:183].strip(),line[183:185].strip(),line[185:187].strip(),line[187:222].strip(),line[222:294].strip(),line[294:339].strip(),line[355:390].strip(),line[390:462].strip(),line[462:507].strip(),line[523:538].strip(),line[538:550].strip(),line[550:565].strip(),line[565:577].strip(),line[577:578].strip(),line[585:586].strip(),line[586:589].strip(),line[589:593].strip(),line[597:627].strip(),line[627:629].strip(),line[629:632].strip(),line[637:641].strip(),line[641:644].strip(),line[644:674].strip(),line[674:678].strip(),line[678:681].strip(),line[681:711].strip(),line[711:712].strip(),line[712:716].strip(),line[716:746].strip(),line[746:762].strip(),line[762:778].strip(),line[778:782].strip(),line[782:812].strip(),line[812:828].strip(),line[828:832].strip(),line[832:833].strip(),line[833:840].strip(),line[840:842].strip(),line[842:857].strip(),line[857:864].strip(),line[864:877].strip(),line[877:878].strip(),line[878:879].strip(),line[879:880].strip(),line[880:881].strip(),line[881:883].strip(),line[883:884].strip(),line[884:892].strip(),line[892:900].strip(),line[900:940].strip(),line[940:945].strip(),line[945:950].strip(),line[950:958].strip(),line[958:966].strip(),line[966:973].strip(),line[973:980].strip(),line[980:981].strip(),line[981:988].strip(),line[988:995].strip(),line[995:999].strip(),line[999:1002].strip(),line[1002:1003].strip(),line[1003:1004].strip(),line[1061:1071].strip(),line[1071:1087].strip(),line[1087:1097].strip(),line[1097:1113].strip(),line[1113:1123].strip(),line[1123:1124].strip(),line[1124:1136].strip(),line[1136:1207].strip(),line[1207:1210].strip(),line[1210:1217].strip(),line[1217:1529].strip()]) + '"'
-                        nfdc_file.write(nfdc_line)
-                line = aptfile.readline()
-                """
-                airport = dict()
-                airport["RECORD TYPE INDICATOR"] = line[0:3].strip()
-                airport["LANDING FACILITY SITE NUMBER"] = line[3:14].strip()
-                airport["LANDING FACILITY TYPE"] = line[14:27].strip()
-                airport["LOCATION IDENTIFIER"] = line[27:31].strip()
-                airport["INFORMATION EFFECTIVE DATE (MM/DD/YYYY)"] = line[31:41].strip()
-                airport["FAA REGION CODE"] = line[41:44].strip()
-                airport["FAA DISTRICT OR FIELD OFFICE CODE"] = line[44:48].strip()
-                airport["ASSOCIATED STATE POST OFFICE CODE"] = line[48:50].strip()
-                airport["ASSOCIATED STATE NAME"] = line[50:70].strip()
-                airport["ASSOCIATED COUNTY (OR PARISH) NAME"] = line[70:91].strip()
-                airport["ASSOCIATED COUNTY'S STATE (POST OFFICE CODE)"] = line[91:93].strip()
-                airport["ASSOCIATED CITY NAME"] = line[93:133].strip()
-                airport["OFFICIAL FACILITY NAME"] = line[133:183].strip()
-                airport["AIRPORT OWNERSHIP TYPE"] = line[183:185].strip()
-                airport["FACILITY USE"] = line[185:187].strip()
-                airport["FACILITY OWNER'S NAME"] = line[187:222].strip()
-                airport["OWNER'S ADDRESS"] = line[222:294].strip()
-                airport["OWNER'S CITY, STATE AND ZIP CODE"] = line[294:339].strip()
-                airport["FACILITY MANAGER'S NAME"] = line[355:390].strip()
-                airport["MANAGER'S ADDRESS"] = line[390:462].strip()
-                airport["MANAGER'S CITY, STATE AND ZIP CODE"] = line[462:507].strip()
-                airport["AIRPORT REFERENCE POINT LATITUDE (FORMATTED)"] = line[523:538].strip()
-                airport["AIRPORT REFERENCE POINT LATITUDE (SECONDS)"] = line[538:550].strip()
-                airport["AIRPORT REFERENCE POINT LONGITUDE (FORMATTED)"] = line[550:565].strip()
-                airport["AIRPORT REFERENCE POINT LONGITUDE (SECONDS)"] = line[565:577].strip()
-                airport["AIRPORT REFERENCE POINT DETERMINATION METHOD"] = line[577:578].strip()
-                airport["AIRPORT ELEVATION DETERMINATION METHOD"] = line[585:586].strip()
-                airport["MAGNETIC VARIATION AND DIRECTION"] = line[586:589].strip()
-                airport["MAGNETIC VARIATION EPOCH YEAR"] = line[589:593].strip()
-                airport["AERONAUTICAL SECTIONAL CHART ON WHICH FACILITY"] = line[597:627].strip()
-                airport["DISTANCE FROM CENTRAL BUSINESS DISTRICT OF"] = line[627:629].strip()
-                airport["DIRECTION OF AIRPORT FROM CENTRAL BUSINESS"] = line[629:632].strip()
-                airport["BOUNDARY ARTCC IDENTIFIER"] = line[637:641].strip()
-                airport["BOUNDARY ARTCC (FAA) COMPUTER IDENTIFIER"] = line[641:644].strip()
-                airport["BOUNDARY ARTCC NAME"] = line[644:674].strip()
-                airport["RESPONSIBLE ARTCC IDENTIFIER"] = line[674:678].strip()
-                airport["RESPONSIBLE ARTCC (FAA) COMPUTER IDENTIFIER"] = line[678:681].strip()
-                airport["RESPONSIBLE ARTCC NAME"] = line[681:711].strip()
-                airport["TIE-IN FSS PHYSICALLY LOCATED ON FACILITY"] = line[711:712].strip()
-                airport["TIE-IN FLIGHT SERVICE STATION (FSS) IDENTIFIER"] = line[712:716].strip()
-                airport["TIE-IN FSS NAME"] = line[716:746].strip()
-                airport["LOCAL PHONE NUMBER FROM AIRPORT TO FSS"] = line[746:762].strip()
-                airport["TOLL FREE PHONE NUMBER FROM AIRPORT TO FSS"] = line[762:778].strip()
-                airport["ALTERNATE FSS IDENTIFIER"] = line[778:782].strip()
-                airport["ALTERNATE FSS NAME"] = line[782:812].strip()
-                airport["TOLL FREE PHONE NUMBER FROM AIRPORT TO"] = line[812:828].strip()
-                airport["IDENTIFIER OF THE FACILITY RESPONSIBLE FOR"] = line[828:832].strip()
-                airport["AVAILABILITY OF NOTAM 'D' SERVICE AT AIRPORT"] = line[832:833].strip()
-                airport["AIRPORT ACTIVATION DATE (MM/YYYY)"] = line[833:840].strip()
-                airport["AIRPORT STATUS CODE"] = line[840:842].strip()
-                airport["AIRPORT ARFF CERTIFICATION TYPE AND DATE"] = line[842:857].strip()
-                airport["NPIAS/FEDERAL AGREEMENTS CODE"] = line[857:864].strip()
-                airport["AIRPORT AIRSPACE ANALYSIS DETERMINATION"] = line[864:877].strip()
-                airport["FACILITY HAS BEEN DESIGNATED BY THE U.S. TREASURY"] = line[877:878].strip()
-                airport["FACILITY HAS BEEN DESIGNATED BY THE U.S. TREASURY"] = line[878:879].strip()
-                airport["FACILITY HAS MILITARY/CIVIL JOINT USE AGREEMENT"] = line[879:880].strip()
-                airport["AIRPORT HAS ENTERED INTO AN AGREEMENT THAT"] = line[880:881].strip()
-                airport["AIRPORT INSPECTION METHOD"] = line[881:883].strip()
-                airport["AGENCY/GROUP PERFORMING PHYSICAL INSPECTION"] = line[883:884].strip()
-                airport["LAST PHYSICAL INSPECTION DATE (MMDDYYYY)"] = line[884:892].strip()
-                airport["LAST DATE INFORMATION REQUEST WAS COMPLETED"] = line[892:900].strip()
-                airport["FUEL TYPES AVAILABLE FOR PUBLIC USE AT THE"] = line[900:940].strip()
-                airport["AIRFRAME REPAIR SERVICE AVAILABILITY/TYPE"] = line[940:945].strip()
-                airport["POWER PLANT (ENGINE) REPAIR AVAILABILITY/TYPE"] = line[945:950].strip()
-                airport["TYPE OF BOTTLED OXYGEN AVAILABLE (VALUE REPRESENTS"] = line[950:958].strip()
-                airport["TYPE OF BULK OXYGEN AVAILABLE (VALUE REPRESENTS"] = line[958:966].strip()
-                airport["AIRPORT LIGHTING SCHEDULE"] = line[966:973].strip()
-                airport["BEACON LIGHTING SCHEDULE"] = line[973:980].strip()
-                airport["AIR TRAFFIC CONTROL TOWER LOCATED ON AIRPORT"] = line[980:981].strip()
-                airport["UNICOM FREQUENCY AVAILABLE AT THE AIRPORT"] = line[981:988].strip()
-                airport["COMMON TRAFFIC ADVISORY FREQUENCY (CTAF)"] = line[988:995].strip()
-                airport["SEGMENTED CIRCLE AIRPORT MARKER SYSTEM ON THE AIRPORT"] = line[995:999].strip()
-                airport["LENS COLOR OF OPERABLE BEACON LOCATED ON THE AIRPORT"] = line[999:1002].strip()
-                airport["LANDING FEE CHARGED TO NON-COMMERCIAL USERS OF"] = line[1002:1003].strip()
-                airport['A "Y" IN THIS FIELD INDICATES THAT THE LANDING'] = line[1003:1004].strip()
-                airport["12-MONTH ENDING DATE ON WHICH ANNUAL OPERATIONS DATA"] = line[1061:1071].strip()
-                airport["AIRPORT POSITION SOURCE"] = line[1071:1087].strip()
-                airport["AIRPORT POSITION SOURCE DATE (MM/DD/YYYY)"] = line[1087:1097].strip()
-                airport["AIRPORT ELEVATION SOURCE"] = line[1097:1113].strip()
-                airport["AIRPORT ELEVATION SOURCE DATE (MM/DD/YYYY)"] = line[1113:1123].strip()
-                airport["CONTRACT FUEL AVAILABLE"] = line[1123:1124].strip()
-                airport["TRANSIENT STORAGE FACILITIES"] = line[1124:1136].strip()
-                airport["OTHER AIRPORT SERVICES AVAILABLE"] = line[1136:1207].strip()
-                airport["WIND INDICATOR"] = line[1207:1210].strip()
-                airport["ICAO IDENTIFIER"] = line[1210:1217].strip()
-                airport["AIRPORT RECORD FILLER (BLANK)"] = line[1217:1529].strip()
-                """
-
-            except:
-                """This is a dumb solution."""
-                print(line)
-                break
-    print(i)
-    nfdc_file.close()
-    return airport_list
+def iter_fixed_width_records(path, record_type='APT', block_size=4*1024*1024):
+    """Yield the lines of one record type from an NFDC fixed-width file
+
+    The file is read in large blocks and the next record is found by
+    searching for a newline followed by record_type, so lines of other
+    record types are skipped without being split out or copied.
+    """
+    marker = b'\n' + record_type
+    with open(path, 'rb') as fixed_width_file:
+        #Every kept buffer starts at a newline so the first record can match too
+        buffer = b'\n'
+        while True:
+            block = fixed_width_file.read(block_size)
+            buffer = buffer + block
+            position = 0
+            while True:
+                start = buffer.find(marker, position)
+                if start == -1:
+                    break
+                end = buffer.find(b'\n', start + 1)
+                if end == -1:
+                    break
+                yield buffer[start + 1:end].rstrip(b'\r')
+                position = end
+            if not block:
+                if start != -1:
+                    yield buffer[start + 1:].rstrip(b'\r\n')
+                return
+            buffer = buffer[start:] if start != -1 else buffer[buffer.rfind(b'\n'):]
+
+
+def iter_nfdc_airports(path='APT.txt', block_size=4*1024*1024):
+    """Yield (airport details, all APT fields) for each landing facility in an NFDC APT.txt file"""
+    for line in iter_fixed_width_records(path, 'APT', block_size):
+        fields = [field.strip() for field in apt_getter(line)]
+        try:
+            latsec = fields[apt_index["AIRPORT REFERENCE POINT LATITUDE (SECONDS)"]]
+            lonsec = fields[apt_index["AIRPORT REFERENCE POINT LONGITUDE (SECONDS)"]]
+            NS = 1
+            if latsec[-1] == 'S':
+                NS = -1
+            EW = 1
+            if lonsec[-1] == 'W':
+                EW = -1
+            airport = {'airport':fields[apt_index["OFFICIAL FACILITY NAME"]],
+                       'lat':NS*float(latsec[0:-1])/3600,
+                       'lon':EW*float(lonsec[0:-1])/3600,
+                       'link':'nfdc',
+                       'state':fields[apt_index["ASSOCIATED STATE POST OFFICE CODE"]],
+                       'city':fields[apt_index["ASSOCIATED CITY NAME"]],
+                       'start':fields[apt_index["INFORMATION EFFECTIVE DATE (MM/DD/YYYY)"]],
+                       'id':fields[apt_index["LOCATION IDENTIFIER"]]}
+        except (IndexError, ValueError):
+            print('Skipping unreadable APT record: {}'.format(line[:50]))
+            continue
+        yield airport, fields
+
+
+@register_source('nfdc', ['APT.txt'])
+def get_nfdc_airport_list(path='APT.txt', csv_path='nfdc.csv', snapshot_path='nfdc_snapshot.npz'):
+    """Read NFDC airport list and return: Country, State, Airport name, Lat, Lon, Operational
+
+    Airports are returned as an AirportTable, which is kept in snapshot_path
+    and reused (without rewriting csv_path) until APT.txt changes. Pass
+    snapshot_path=None to always re-read APT.txt.
+    """
+    if os.path.isfile(csv_path):
+        airport_table = load_snapshot(snapshot_path, path)
+        if airport_table is not None:
+            return airport_table
+    airport_table = AirportTable.from_records(iter_nfdc_csv_airports(path, csv_path))
+    print(len(airport_table))
+    save_snapshot(airport_table, snapshot_path, path)
+    return airport_table
+
+
+def iter_nfdc_csv_airports(path='APT.txt', csv_path='nfdc.csv'):
+    """Yield NFDC airports, writing every field of each one with a state to csv_path as it goes"""
+    with open(csv_path,'w') as nfdc_file:
+        nfdc_header = '"' + '","'.join([name.replace("'",'').replace('"','') for name, start, end in apt_columns]) + '"'
+        nfdc_file.write(nfdc_header)
+        state_field = apt_index["ASSOCIATED STATE POST OFFICE CODE"]
+        for airport, fields in iter_nfdc_airports(path):
+            if len(fields[state_field]) > 0:
+                nfdc_file.write('\n"' + '","'.join(fields) + '"')
+            yield airport
     
 
+@register_source('website', ['*.htm'], in_pool=False)
+def get_website_airport_list(parser='soup', workers=None, cache_path=parse_cache_file):
+    """Return the airports of the downloaded airfield pages as an AirportTable, see read_airport_files"""
+    return AirportTable.from_records(read_airport_files(workers=workers, cache_path=cache_path, parser=parser))
+
+
+@register_source('ourairports', ['airports.csv'])
+def get_ourairports_airport_list(path='airports.csv', country='US', columns=ourairports_columns, snapshot_path='ourairports_snapshot.npz'):
+    """Read an OurAirports style airports.csv and return the airports of one country as an AirportTable
+    Source: https://ourairports.com/data/
+
+    Facilities typed closed are marked closed, and heliports and seaplane
+    bases are left out as they are by the NFDC comparison."""
+    airport_table = load_snapshot(snapshot_path, path)
+    if airport_table is not None:
+        return airport_table
+
+    def airports():
+        with open(path, 'rb') as csvfile:
+            for row in csv.DictReader(csvfile):
+                if row[columns['country']] != country or row[columns['type']] in ('heliport', 'seaplane_base', 'balloonport'):
+                    continue
+                try:
+                    lat, lon = float(row[columns['lat']]), float(row[columns['lon']])
+                except ValueError:
+                    print('Skipping unreadable OurAirports row: {}'.format(row[columns['id']]))
+                    continue
+                yield {'airport':row[columns['airport']],
+                       'lat':lat,
+                       'lon':lon,
+                       'link':row[columns['link']] or 'https://ourairports.com/airports/{}/'.format(row[columns['id']]),
+                       'state':row[columns['region']].split('-')[-1],
+                       'city':row[columns['city']],
+                       'closed':'1' if row[columns['type']] == 'closed' else '0',
+                       'id':row[columns['id']]}
+
+    airport_table = AirportTable.from_records(airports())
+    save_snapshot(airport_table, snapshot_path, path)
+    return airport_table
+
+
+def get_available_sources():
+    """Return the names of registered sources with at least one of their files on disk"""
+    return [name for name, source in airport_sources.items() if any(glob.glob(pattern) for pattern in source.files)]
+
+
+def load_airport_source(job):
+    """Run one registered loader with keyword options, returning (name, AirportTable)"""
+    name, options = job
+    return name, airport_sources[name].loader(**options)
+
+
+def load_sources(names=None, options=None, workers=None):
+    """Load registered airport sources concurrently and return {name: AirportTable} in the order asked for
+
+    Sources that can run in a worker load in a process pool of up to workers
+    processes (None for one per source up to the number of cores), while
+    those that spread their own work over processes, like the website pages,
+    load in this process alongside them. options maps a source name to
+    keyword arguments for its loader. Every source hands back an AirportTable,
+    so later stages treat them all alike.
+    """
+    names = names or get_available_sources()
+    options = options or dict()
+    jobs = [(name, options.get(name, dict())) for name in names]
+    pooled = [job for job in jobs if airport_sources[job[0]].in_pool]
+    local = [job for job in jobs if not airport_sources[job[0]].in_pool]
+    tables = dict()
+    pool = None
+    if workers != 1 and len(jobs) > 1 and pooled:
+        pool = multiprocessing.Pool(workers or min(len(pooled), multiprocessing.cpu_count()))
+        results = pool.map_async(load_airport_source, pooled)
+    else:
+        local = jobs
+    try:
+        for job in local:
+            name, table = load_airport_source(job)
+            tables[name] = table
+        if pool is not None:
+            tables.update(results.get())
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return collections.OrderedDict((name, tables[name]) for name in names)
+
+
 def get_lat_lon_from_list(airports):
-    lat = [float(airport.get('lat')) for airport in airports]
-    lon = [float(airport.get('lon')) for airport in airports]
+    """Return numpy arrays of airport latitudes and longitudes"""
+    if isinstance(airports, AirportTable):
+        return airports.coordinates()
+    lat = np.fromiter((float(airport.get('lat')) for airport in airports), dtype=np.float64, count=len(airports))
+    lon = np.fromiter((float(airport.get('lon')) for airport in airports), dtype=np.float64, count=len(airports))
     return lat,lon
 
 
-def main():
-    print('Scraping... %s' % datetime.datetime.now().time())
-    scrape_airports()
-    print('Reading... %s' % datetime.datetime.now().time())
-    airports = read_airport_files()
-    print('Writing csv... %s' % datetime.datetime.now().time())
-    write_csv_file(airports)
-    print('Writing kml... %s' % datetime.datetime.now().time())
-    write_kml_file(airports)
-    print('Reading BTS... %s' % datetime.datetime.now().time())
-    
-    bts_airports = get_bts_airport_list()
+def get_record_coordinates(airports):
+    """Read an iterable of airports in one pass, keeping only their latitudes and longitudes as numpy arrays"""
+    lat = array.array('d')
+    lon = array.array('d')
+    for airport in airports:
+        lat.append(float(airport.get('lat')))
+        lon.append(float(airport.get('lon')))
+    return (np.frombuffer(lat, dtype=np.float64) if len(lat) else np.zeros(0),
+            np.frombuffer(lon, dtype=np.float64) if len(lon) else np.zeros(0))
+
+
+def get_cpu_seconds():
+    """Return user and system CPU time of this process and its finished child processes"""
+    return sum(os.times()[:4])
+
+
+def get_peak_memory_mb():
+    """Return the peak resident memory of this process since it started, None where it can't be measured"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is kilobytes on Linux but bytes on macOS
+    if sys.platform == 'darwin':
+        return peak/(1024*1024.0)
+    return peak/1024.0
+
+
+def get_child_pids():
+    """Return the ids of this process's child processes from /proc
+
+    Kernels that list each thread's children in /proc/<pid>/task/*/children
+    are answered from those alone, otherwise every process in /proc is
+    checked for this one as its parent.
+    """
+    pid = os.getpid()
+    children_files = glob.glob('/proc/{}/task/*/children'.format(pid))
+    if children_files:
+        pids = []
+        for children_file in children_files:
+            try:
+                with open(children_file) as children:
+                    pids.extend(int(child) for child in children.read().split())
+            except (IOError, OSError, ValueError):
+                #Thread finished between listing and reading
+                continue
+        return pids
+    pids = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as stat_file:
+                #The process name may hold spaces, the parent id is the second field after it
+                if int(stat_file.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    pids.append(int(name))
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+    return pids
+
+
+def get_resident_memory_mb():
+    """Return the current resident memory of this process and its child processes, None without /proc"""
+    if not os.path.isfile('/proc/self/statm'):
+        return None
+    pids = [os.getpid()] + get_child_pids()
+    pages = 0
+    for process in pids:
+        try:
+            with open('/proc/{}/statm'.format(process)) as statm_file:
+                pages += int(statm_file.read().split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            #Finished between listing and reading
+            continue
+    return pages*os.sysconf('SC_PAGE_SIZE')/(1024*1024.0)
+
+
+class MemorySampler(object):
+    """Track the highest resident memory of this process and its workers on a background thread
+
+    Sampling runs in this process, so its CPU time counts towards the
+    stage being measured. The interval keeps that to a small fraction of a
+    CPU, and brief peaks of this process between samples are still caught
+    from its lifetime peak when sampling stops.
+    """
+
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.start_mb = self.peak_mb = get_resident_memory_mb()
+        self.process_peak_mb = get_peak_memory_mb()
+        self.stopped = threading.Event()
+        self.thread = None
+        if self.start_mb is not None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        current = get_resident_memory_mb()
+        if current is not None and current > self.peak_mb:
+            self.peak_mb = current
+
+    def stop(self):
+        """Stop sampling, returning (peak, peak less the memory in use at the start), both None without /proc"""
+        if self.thread is None:
+            return None, None
+        self.stopped.set()
+        self.thread.join()
+        self._sample()
+        #A new lifetime peak of this process was reached during the stage, however briefly
+        process_peak_mb = get_peak_memory_mb()
+        if process_peak_mb is not None and process_peak_mb > self.process_peak_mb:
+            self.peak_mb = max(self.peak_mb, process_peak_mb)
+        return self.peak_mb, self.peak_mb - self.start_mb
+
+
+def get_files_size(filenames):
+    """Return the combined size of the files that exist"""
+    return sum([os.path.getsize(filename) for filename in filenames if os.path.isfile(filename)])
+
+
+class PipelineStats(object):
+    """Timing and resource use of each stage of a pipeline run
+
+    Wrap each step in stage(); the dict it yields can be given 'records' and
+    'bytes' counts. Filled in automatically are wall time, CPU time of this
+    process and its finished workers (including the little spent by
+    MemorySampler), and memory: peak_rss_mb is the highest resident memory
+    of this process plus its worker processes sampled during the stage,
+    rss_growth_mb is how far that rose above the memory in use when the
+    stage began (both None without /proc), and process_peak_memory_mb is
+    this process's own peak since it started. write() saves the run as
+    json. With profile_path set every stage also runs under cProfile, and
+    the combined profile is dumped there for pstats.
+    """
+
+    def __init__(self, profile_path=None):
+        self.started = datetime.datetime.now()
+        self.stages = []
+        self.profile_path = profile_path
+        self.profiler = cProfile.Profile() if profile_path else None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        print('{}... {}'.format(name, datetime.datetime.now().time()))
+        record = {'stage':name, 'records':None, 'bytes':None}
+        wall_start = time.time()
+        cpu_start = get_cpu_seconds()
+        sampler = MemorySampler()
+        if self.profiler:
+            self.profiler.enable()
+        try:
+            yield record
+        finally:
+            if self.profiler:
+                self.profiler.disable()
+            record['wall_seconds'] = time.time() - wall_start
+            record['cpu_seconds'] = get_cpu_seconds() - cpu_start
+            record['peak_rss_mb'], record['rss_growth_mb'] = sampler.stop()
+            record['process_peak_memory_mb'] = get_peak_memory_mb()
+            self.stages.append(record)
+
+    def write(self, path):
+        """Save the stage records as json, and the cProfile dump if profiling"""
+        write_json_file({'started':self.started.isoformat(),
+                         'wall_seconds':sum([record['wall_seconds'] for record in self.stages]),
+                         'stages':self.stages}, path, indent=1)
+        if self.profiler:
+            self.profiler.dump_stats(self.profile_path)
+
+
+def stream_pipeline(stats, parser='soup', filter_dist=5, kmz=False):
+    """Run the comparisons of main() as a stream, holding only the coordinates of the reference airports
+
+    Website airports go to csv and kml as their pages are parsed and NFDC
+    airports are read in one pass into an index. BTS airports are then
+    checked against NFDC and the website airports one row at a time, and
+    those still missing are written to missing_items.csv and kml straight
+    away. Memory grows with the reference coordinates only. Leaflet tiles,
+    clusters and change reports need every airport at once, so they are
+    left to the full pipeline.
+    """
+    with stats.stage('Streaming website airports') as stage:
+        kml_writer = KmlWriter(kmz=kmz)
+        with open('./abandoned_airports.csv','w') as csv_output_file:
+            csv_output_file.write(csv_head)
+
+            def written_airports():
+                for airport in iter_airport_files(workers=None, cache_path=None, parser=parser):
+                    csv_output_file.write(get_csv_line(airport))
+                    kml_writer.add(airport)
+                    yield airport
+
+            website_lat, website_lon = get_record_coordinates(written_airports())
+        kml_writer.close()
+        website_index = AirportIndex(website_lat, website_lon)
+        stage['records'] = len(website_lat)
+        stage['bytes'] = get_files_size([filename for filename in os.listdir('./') if filename.endswith('.htm')])
+    with stats.stage('Indexing NFDC') as stage:
+        nfdc_lat, nfdc_lon = get_record_coordinates(iter_nfdc_csv_airports())
+        nfdc_index = AirportIndex(nfdc_lat, nfdc_lon)
+        stage['records'] = len(nfdc_lat)
+        stage['bytes'] = get_files_size(['APT.txt'])
+    with stats.stage('Streaming BTS comparison') as stage:
+        stage['records'] = missing_count = 0
+        kml_writer = KmlWriter('missing_items', kmz=kmz)
+        with open('./missing_items.csv','w') as csv_output_file:
+            csv_output_file.write(missing_csv_head + '\n')
+            for airport in iter_bts_airports():
+                stage['records'] += 1
+                if nfdc_index.nearest(airport['lat'], airport['lon'], max_dist=filter_dist)[0] <= filter_dist:
+                    continue
+                if website_index.nearest(airport['lat'], airport['lon'], max_dist=filter_dist)[0] <= filter_dist:
+                    continue
+                csv_output_file.write(get_missing_csv_line(airport) + '\n')
+                kml_writer.add(airport)
+                missing_count += 1
+        kml_writer.close()
+        stage['bytes'] = get_files_size(['737306034_T_MASTER_CORD.csv'])
+    print('{} bts airports streamed, {} missing from NFDC and the website.'.format(stage['records'], missing_count))
+
+
+def main(stats_path='pipeline_stats.json', profile_path=None, parser='soup', cluster_radius=2, stream=False):
+    stats = PipelineStats(profile_path)
+    with stats.stage('Scraping') as stage:
+        stage['bytes'] = scrape_airports()
+    if stream:
+        stream_pipeline(stats, parser=parser)
+        stats.write(stats_path)
+        return
+    with stats.stage('Loading sources') as stage:
+        #Any other registered source with files present is loaded too and joins the clustering
+        names = ['website', 'bts', 'nfdc'] + [name for name in get_available_sources() if name not in ('website', 'bts', 'nfdc')]
+        sources = load_sources(names, options={'website':{'parser':parser}})
+        airports, bts_airports, nfdc_airports = sources['website'], sources['bts'], sources['nfdc']
+        stage['records'] = sum(len(table) for table in sources.values())
+        stage['bytes'] = get_files_size([filename for name in names for pattern in airport_sources[name].files for filename in glob.glob(pattern)])
+    with stats.stage('Writing csv') as stage:
+        write_csv_file(airports)
+        stage['records'] = len(airports)
+        stage['bytes'] = get_files_size(['./abandoned_airports.csv'])
+    with stats.stage('Writing kml') as stage:
+        write_kml_file(airports)
+        stage['records'] = len(airports)
+        stage['bytes'] = get_files_size(['./abandoned_airports.kml'])
+    with stats.stage('Writing leaflet tiles') as stage:
+        write_leaflet_tiles(airports)
+        stage['records'] = len(airports)
+
     #pp = pprint.PrettyPrinter(indent=4)
     #pp.pprint(bts_airports)
-    print('Reading NFDC... %s' % datetime.datetime.now().time())
-    nfdc_airports = get_nfdc_airport_list()
     #print(nfdc_airports)
     print('Finishing... %s' % datetime.datetime.now().time())
     
@@ -473,10 +2380,35 @@ def main():
     print('{} bts airports parsed.'.format(len(bts_airports)))
     print('{} nfdc airports parsed.'.format(len(nfdc_airports)))
     
-    potential_missing_facilities = compare_locations(nfdc_airports,bts_airports)
-    compare_locations(airports,potential_missing_facilities)
-    #TODO: Check if open airports exist in the same location as the closed results
-    pass
+    with stats.stage('Comparing BTS to NFDC') as stage:
+        potential_missing_facilities = compare_locations(nfdc_airports,bts_airports,baseline_path='bts_nfdc_comparison',report_path='./bts_nfdc_changes.csv')
+        stage['records'] = len(bts_airports)
+    with stats.stage('Comparing to website airports') as stage:
+        missing_items = compare_locations(airports,potential_missing_facilities,baseline_path='website_comparison',report_path='./website_changes.csv')
+        stage['records'] = len(potential_missing_facilities)
+    with stats.stage('Clustering') as stage:
+        #Likely closed facilities grouped with everything near them, only their clusters are written
+        clusters = cluster_airports([('candidate', missing_items), ('nfdc', nfdc_airports), ('bts', bts_airports), ('website', airports)] +
+                                    [(name, table) for name, table in sources.items() if name not in ('website', 'bts', 'nfdc')], radius=cluster_radius)
+        clusters = [cluster for cluster in clusters if cluster['candidate']]
+        write_clusters_csv(clusters)
+        stage['records'] = len(missing_items)
+    print('{} likely closed facilities in {} clusters, {} clusters include an open facility.'.format(stage['records'], len(clusters), len([cluster for cluster in clusters if cluster['open']])))
+    stats.write(stats_path)
+
+def get_positive_km(value):
+    """argparse type for a distance in km that must be greater than zero"""
+    km = float(value)
+    if not km > 0:
+        raise argparse.ArgumentTypeError('{} is not a distance greater than 0 km'.format(value))
+    return km
 
 if __name__ == '__main__':
-    main()
+    arg_parser = argparse.ArgumentParser(description='Download abandoned airfield lists and compare them to BTS and NFDC airports')
+    arg_parser.add_argument('--stats', default='pipeline_stats.json', help='json file for per-stage timing')
+    arg_parser.add_argument('--profile', default=None, help='write a cProfile dump of the run to this file')
+    arg_parser.add_argument('--parser', default='soup', choices=['soup', 'fast', 'parity'], help='how to read the airfield pages')
+    arg_parser.add_argument('--cluster-radius', type=get_positive_km, default=2, help='km within which facilities are treated as one')
+    arg_parser.add_argument('--stream', action='store_true', help='stream the comparison with bounded memory, skipping tiles, clusters and change reports')
+    args = arg_parser.parse_args()
+    main(stats_path=args.stats, profile_path=args.profile, parser=args.parser, cluster_radius=args.cluster_radius, stream=args.stream)
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Serves nearest, radius and bounding box queries over the airport datasets
+
+Loads every registered airport source (BTS, NFDC, the abandoned airfield
+lists and any others with files present) once, keeps each one indexed in
+memory and answers JSON queries over HTTP:
+
+    /nearest?lat=40.5&lon=-80.2[&source=bts][&max_km=5]
+    /radius?lat=40.5&lon=-80.2&km=10[&source=nfdc][&limit=100]
+    /bbox?south=40&west=-81&north=41&east=-80[&source=website][&limit=100]
+    /metrics
+
+A background thread watches each dataset's source files and, when they
+change, loads and indexes the new version before swapping it in, so
+queries never see a half-loaded dataset.
+
+Usage: python airfield_service.py [--port 8080] [--reload-interval 30]
+"""
+
+import os
+import glob
+import json
+import time
+import threading
+import traceback
+import collections
+import argparse
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+import numpy as np
+
+import airfield_scraper
+
+
+#Keyword arguments for the registered source loaders, see airfield_scraper.load_sources
+#The service parses with a different parser than airfield_scraper.main, so it keeps its own parse cache
+loader_options = {'website':{'parser':'fast', 'cache_path':'service_parse_cache.json'}}
+
+
+def get_source_signature(patterns):
+    """Return the (name, size, modified time) of every file matching patterns"""
+    signature = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            stat = os.stat(path)
+            signature.append((path, stat.st_size, stat.st_mtime))
+    return tuple(signature)
+
+
+class Dataset(object):
+    """An AirportTable with its spatial index and the source files it was loaded from"""
+
+    def __init__(self, name, airports, signature):
+        self.name = name
+        self.airports = airports
+        self.index = airfield_scraper.AirportIndex(*airports.coordinates())
+        self.signature = signature
+        self.loaded = time.time()
+
+
+class LatencyStats(object):
+    """Request count and latency percentiles per endpoint over the most recent requests"""
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.errors = collections.Counter()
+        self.recent = collections.defaultdict(lambda: collections.deque(maxlen=window))
+
+    def record(self, endpoint, seconds, error=False):
+        with self.lock:
+            self.counts[endpoint] += 1
+            if error:
+                self.errors[endpoint] += 1
+            self.recent[endpoint].append(seconds)
+
+    def summary(self):
+        with self.lock:
+            summary = dict()
+            for endpoint, recent in self.recent.items():
+                latencies = np.array(recent)*1000.0
+                summary[endpoint] = {'requests':self.counts[endpoint],
+                                     'errors':self.errors[endpoint],
+                                     'mean_ms':float(latencies.mean()),
+                                     'p50_ms':float(np.percentile(latencies, 50)),
+                                     'p95_ms':float(np.percentile(latencies, 95)),
+                                     'p99_ms':float(np.percentile(latencies, 99)),
+                                     'max_ms':float(latencies.max())}
+            return summary
+
+
+class AirportService(object):
+    """Loaded datasets plus the queries the HTTP handler answers from them"""
+
+    def __init__(self, names=None):
+        self.names = names or list(airfield_scraper.airport_sources)
+        self.datasets = dict()
+        self.reloads = collections.Counter()
+        self.latency = LatencyStats()
+        self.reload_lock = threading.Lock()
+
+    def refresh(self):
+        """Load any dataset whose source files changed, swapping each one in once it is indexed"""
+        with self.reload_lock:
+            for name in self.names:
+                source = airfield_scraper.airport_sources[name]
+                signature = get_source_signature(source.files)
+                current = self.datasets.get(name)
+                if not signature or (current is not None and current.signature == signature):
+                    continue
+                print('Loading {} dataset...'.format(name))
+                try:
+                    dataset = Dataset(name, source.loader(**loader_options.get(name, dict())), signature)
+                except Exception as e:
+                    print('Could not load {} dataset, keeping the old one. {}: {}'.format(name, type(e).__name__, e))
+                    continue
+                #Replacing the whole dict is atomic, a request sees either the old or the new datasets
+                datasets = dict(self.datasets)
+                datasets[name] = dataset
+                self.datasets = datasets
+                if current is not None:
+                    self.reloads[name] += 1
+                print('{} dataset ready with {} airports.'.format(name, len(dataset.airports)))
+
+    def watch(self, interval):
+        """Check for changed source files every interval seconds on a background thread"""
+        def run():
+            while True:
+                time.sleep(interval)
+                self.refresh()
+        watcher = threading.Thread(target=run)
+        watcher.daemon = True
+        watcher.start()
+        return watcher
+
+    def select(self, datasets, params):
+        """Return the datasets named by the source parameter, all of them by default"""
+        names = params.get('source')
+        if not names:
+            return [datasets[name] for name in self.names if name in datasets]
+        unknown = [name for name in names if name not in datasets]
+        if unknown:
+            raise ValueError('Unknown or unloaded source: {}'.format(', '.join(unknown)))
+        return [datasets[name] for name in names]
+
+    def nearest(self, datasets, params):
+        lat, lon = get_float(params, 'lat'), get_float(params, 'lon')
+        max_km = get_float(params, 'max_km', None)
+        results = dict()
+        for dataset in self.select(datasets, params):
+            distance, position = dataset.index.nearest(lat, lon, max_dist=max_km)
+            results[dataset.name] = None if position == -1 else dict(dataset.airports[position], distance_km=distance)
+        return results
+
+    def radius(self, datasets, params):
+        lat, lon, km = get_float(params, 'lat'), get_float(params, 'lon'), get_float(params, 'km')
+        limit = int(get_float(params, 'limit', 1000))
+        results = dict()
+        for dataset in self.select(datasets, params):
+            positions = dataset.index.within(lat, lon, km)
+            distances = airfield_scraper.haversine_np(lon, lat, dataset.airports.lon[positions], dataset.airports.lat[positions])
+            results[dataset.name] = {'count':len(positions),
+                                     'airports':[dict(dataset.airports[position], distance_km=float(distance)) for position, distance in zip(positions[:limit], distances[:limit])]}
+        return results
+
+    def bbox(self, datasets, params):
+        south, west = get_float(params, 'south'), get_float(params, 'west')
+        north, east = get_float(params, 'north'), get_float(params, 'east')
+        limit = int(get_float(params, 'limit', 1000))
+        results = dict()
+        for dataset in self.select(datasets, params):
+            lat, lon = dataset.airports.coordinates()
+            inside = (lat >= south) & (lat <= north)
+            if west <= east:
+                inside &= (lon >= west) & (lon <= east)
+            else:
+                #Box crosses the antimeridian
+                inside &= (lon >= west) | (lon <= east)
+            positions = np.nonzero(inside)[0]
+            results[dataset.name] = {'count':len(positions),
+                                     'airports':[dataset.airports[position] for position in positions[:limit]]}
+        return results
+
+    def metrics(self, datasets, params):
+        return {'latency':self.latency.summary(),
+                'datasets':dict((name, {'airports':len(dataset.airports),
+                                        'loaded':dataset.loaded,
+                                        'reloads':self.reloads[name],
+                                        'files':len(dataset.signature)}) for name, dataset in datasets.items())}
+
+
+def get_float(params, name, default=ValueError):
+    """Return a query parameter as a float, raising ValueError if a required one is missing"""
+    values = params.get(name)
+    if not values:
+        if default is ValueError:
+            raise ValueError('Missing parameter: {}'.format(name))
+        return default
+    return float(values[0])
+
+
+def to_json(data):
+    """Serialise a response, tolerating text that is not utf-8"""
+    try:
+        return json.dumps(data)
+    except UnicodeDecodeError:
+        return json.dumps(data, encoding='latin-1')
+
+
+class AirportRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    endpoints = ('nearest', 'radius', 'bbox', 'metrics')
+
+    def do_GET(self):
+        started = time.time()
+        url = urlparse.urlsplit(self.path)
+        endpoint = url.path.strip('/')
+        service = self.server.service
+        status = 200
+        if endpoint not in self.endpoints:
+            status, body = 404, {'error':'Unknown endpoint, use one of: {}'.format(', '.join(self.endpoints))}
+        else:
+            try:
+                body = getattr(service, endpoint)(service.datasets, urlparse.parse_qs(url.query))
+            except ValueError as e:
+                status, body = 400, {'error':str(e)}
+            except Exception as e:
+                traceback.print_exc()
+                status, body = 500, {'error':'{}: {}'.format(type(e).__name__, e)}
+        payload = to_json(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        service.latency.record(endpoint if endpoint in self.endpoints else 'unknown', time.time() - started, error=status != 200)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AirportServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, AirportRequestHandler)
+        self.service = service
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Serve queries over the airport datasets')
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8080)
+    arg_parser.add_argument('--reload-interval', type=float, default=30, help='seconds between checks for changed source files')
+    arg_parser.add_argument('--sources', nargs='+', default=list(airfield_scraper.airport_sources), choices=list(airfield_scraper.airport_sources))
+    args = arg_parser.parse_args()
+
+    service = AirportService(args.sources)
+    service.refresh()
+    service.watch(args.reload_interval)
+    server = AirportServer((args.host, args.port), service)
+    print('Serving {} on http://{}:{}/'.format(', '.join(sorted(service.datasets)), args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == '__main__':
+    main()